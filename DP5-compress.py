@@ -1,45 +1,109 @@
 #!/usr/bin/env python2.7
+from __future__ import print_function
 import re
 import argparse
 import os
+import io
+import json
 import shutil
+import hashlib
 import subprocess
 import sys
+import time
+import threading
 import numpy as np
 import tarfile
+from distutils.spawn import find_executable
+from multiprocessing.pool import ThreadPool
+import journal_pickling as jp
+from runner import run_command
+from resources import ResourceManager, total_cores
 
 '''
     This code will allow for compression and decompression of labs. This will make archiving runs much easier.
     Currently, the run archived will contain the measurement set with uncorrected data,
     he h5parms for the corrected data and models. These are tarred, so they can be compressed using
     pigz afterwards.
+    The archive mode (-a) does all of this in one pass: the files are streamed
+    straight into a .tar.gz compressed by pigz on all cores, with a manifest of
+    sizes and checksums, and the only copy on disk is the dysco ms.
+    Runs with several measurement sets are compressed and restored (-d) with
+    all ms in parallel. The restore predicts the model of the last calibration
+    in the journal and applies all its solutions in a single DPPP pass.
 '''
 
-def close_run(rname, ms):
+# The calibration types by their step letter in the journal: the image
+# folder of a step, the h5parms it applies with their corrections, and the
+# column the corrected data ends up in
+CALIBRATIONS = {
+    'p': ('pcal{}', [('instrument_{}.h5', ['phase000'])], 'CORRECTED_DATA'),
+    't': ('teccal{}', [('instrument_t{}.h5', ['tec000'])], 'CORRECTED_DATA'),
+    'a': ('tpcal{}', [('instrument_tp{}.h5', ['phase000', 'tec000'])], 'CORRECTED_DATA'),
+    'd': ('apcal{}', [('instrument_p{}.h5', ['phase000']), ('instrument_a{}.h5', ['phase000', 'amplitude000'])], 'CORRECTED_DATA2'),
+}
+
+def find_ms(path):
+    '''
+        path if it is a measurement set, else the measurement sets in it
+    '''
+    path = path.rstrip('/') + '/'
+    if os.path.isfile('{}table.dat'.format(path)):
+        return [path]
+    # Leaving out the backups and leftovers of phase-ups, like DP5.py
+    return ['{0}{1}/'.format(path, name) for name in sorted(os.listdir(path))
+            if os.path.isfile('{0}{1}/table.dat'.format(path, name)) and not name.endswith(('_prepu', '_pu', '.copying'))]
+
+def instrument_dir(rname, ms_name, nms):
+    # A run with a single ms keeps the old flat layout
+    if nms == 1:
+        return '{}instruments/'.format(rname)
+    return '{0}instruments/{1}/'.format(rname, ms_name)
+
+def dysco_call(ms, out):
+    return 'DPPP msin={0} msout={1} msout.storagemanager=dysco msout.datacolumn=DATA msin.datacolumn=DATA steps=[]'.format(ms, out)
+
+def start_pool(ntasks, threads = None):
+    '''
+        Thread pool running ntasks calls, with the cores split between them
+    '''
+    resources = ResourceManager(threads)
+    nworkers = resources.workers(ntasks)
+    resources.export(nworkers)
+    return ThreadPool(nworkers)
+
+def close_run(rname, ms, threads = None):
     assert rname[-1] == '/'
-    assert ms[-1] == '/'
-    ms_name = re.sub(r'.*/','/', ms.rstrip('/'))
-    print(ms,ms_name)
-    try:
-        os.mkdir('{}instruments'.format(rname))
-    except OSError:
-        pass
+    mslist = find_ms(ms)
+    log = jp.Locker('{}log'.format(rname))
     try:
         os.mkdir('{}/lastrun'.format(rname))
     except OSError:
         pass
-    dirlist = os.listdir(ms)
-    instruments = list(filter(lambda x: 'instrument' in x, dirlist))
-    for inst in instruments:
-        shutil.copy2('{0}{1}'.format(ms,inst), '{0}instruments/{1}'.format(rname,inst))
+    for msin in mslist:
+        ms_name = os.path.basename(msin.rstrip('/'))
+        target = instrument_dir(rname, ms_name, len(mslist))
+        try:
+            os.makedirs(target)
+        except OSError:
+            pass
+        instruments = list(filter(lambda x: 'instrument' in x, os.listdir(msin)))
+        for inst in instruments:
+            shutil.copy2('{0}{1}'.format(msin,inst), '{0}{1}'.format(target,inst))
     shutil.copytree('models/', '{}models'.format(rname))
-    # Copy the measurement set compressed. You can re-gain the correction
-    # by applying the applycal step again
-    callstring = 'DPPP msin={0} msout={1}{2} msout.storagemanager=dysco msout.datacolumn=DATA msin.datacolumn=DATA steps=[]'.format(ms, rname, ms_name)
-    print(callstring)
-    subprocess.call(callstring, shell = True)
+    # Copy the measurement sets compressed, all at the same time. You can
+    # re-gain the correction by applying the applycal step again
+    calls = [dysco_call(msin, '{0}{1}'.format(rname, os.path.basename(msin.rstrip('/')))) for msin in mslist]
+    pool = start_pool(len(calls), threads)
+    try:
+        codes = pool.map(lambda call: run_command(call, log, 'compress'), calls)
+    finally:
+        pool.close()
+        pool.join()
+    for call, code in zip(calls, codes):
+        if code:
+            print('Failed: {}'.format(call))
     dirlist = os.listdir(rname)
-    callist = list(filter(lambda x: 'cal' in x, dirlist))
+    callist = list(filter(lambda x: 'cal' in x or x == 'init', dirlist))
     for cal in callist:
         try:
             shutil.copyfile('{0}{1}/ws-MFS-model.fits'.format(rname,cal), '{0}models/{1}-model.fits'.format(rname, cal))
@@ -49,36 +113,276 @@ def close_run(rname, ms):
     print('| Compression complete                    |\n')
     print('| Please fill the lastrun folder manually |\n')
     print('| After that, use tar+pigz -1             |\n')
+    print('| (or archive in one go with -a)          |\n')
     print('+-----------------------------------------+')
 
 
-def uncompress_diag(rname):
+class HashReader(object):
+    '''
+        File wrapper that computes the sha1 of everything read through it
+    '''
+    def __init__(self, handle):
+        self.handle = handle
+        self.digest = hashlib.sha1()
+        self.size = 0
+
+    def read(self, size = -1):
+        data = self.handle.read(size)
+        self.digest.update(data)
+        self.size += len(data)
+        return data
+
+def add_tree(tar, path, arcname, manifest):
+    '''
+        Adds the file or directory path to the open tar as arcname, and the
+        size and sha1 of every file in it to manifest
+    '''
+    todo = [(path, arcname)]
+    while todo:
+        path, arcname = todo.pop(0)
+        info = tar.gettarinfo(path, arcname)
+        if info.isfile():
+            with open(path, 'rb') as handle:
+                reader = HashReader(handle)
+                tar.addfile(info, reader)
+            manifest[arcname] = {'size': reader.size, 'sha1': reader.digest.hexdigest()}
+        else:
+            tar.addfile(info)
+        if info.isdir():
+            todo += [(os.path.join(path, name), '{0}/{1}'.format(arcname, name)) for name in sorted(os.listdir(path))]
+
+def archive_run(rname, ms, out = None, threads = None):
+    '''
+        Writes the run to the tarball out (default <run>.tar.gz), with the
+        same content close_run collects: the dysco compressed ms, the
+        instruments, models/, the journal and the final model of every
+        calibration. The DPPP passes of all ms run while the other files are
+        compressed; their output goes to DP5_SCRATCH if set and every ms is
+        removed as soon as it is in the archive.
+    '''
     assert rname[-1] == '/'
-    dirlist = os.listdir(rname)
-    ms_name = list(filter(lambda x: '.ms' in x, dirlist))[0] # probably the worst way to find a ms
-    model_full = list(filter(lambda x: '-model.fits' in x, os.listdir('{}lastrun/'.format(rname))))[0] # find the model in an equally shitty way
-    model = model_full.rstrip('-model.fits')
-    callstring = 'wsclean -predict -name {2}lastrun/{0} {2}{1}'.format(model,ms_name, rname)
-    subprocess.call(callstring, shell = True)
-    instrumentlist = list(filter(lambda x: 'instrument' in x, os.listdir('{}lastrun'.format(rname))))
-    if len(instrumentlist) > 1:
-        h5_p = list(filter(lambda x: 'instrument_p' in x, instrumentlist))[0]
-        h5_a = list(filter(lambda x: 'instrument_a' in x, instrumentlist))[0]
-        phasestring = 'DPPP msin={2}{0} msout=. steps=[applycal] msout.datacolumn=CORRECTED_PHASE msout.storagemanager=dysco applycal.parmdb={2}lastrun/{1} applycal.correction=phase000'.format(ms_name, h5_p, rname)
-        ampstring = 'DPPP msin={2}{0} msout=. steps=[applycal1,applycal2] msin.datacolumn=CORRECTED_PHASE msout.datacolumn=CORRECTED_DATA2 msout.storagemanager=dysco applycal1.parmdb={2}lastrun/{1} applycal1.correction=phase000 applycal2.parmdb={2}lastrun/{1} applycal2.correction=amplitude000'.format(ms_name, h5_a,rname)
-        subprocess.call(phasestring, shell = True)
-        subprocess.call(ampstring, shell = True)
+    mslist = find_ms(ms)
+    top = os.path.basename(rname.rstrip('/'))
+    if out is None:
+        out = '{}.tar.gz'.format(rname.rstrip('/'))
+    if threads is None:
+        threads = total_cores()
+    log = jp.Locker('{}log'.format(rname))
+    scratch = os.environ.get('DP5_SCRATCH', rname)
+    names = [os.path.basename(msin.rstrip('/')) for msin in mslist]
+    dyscos = [os.path.join(scratch, '{}.dysco'.format(ms_name)) for ms_name in names]
+    for dysco in dyscos:
+        shutil.rmtree(dysco, ignore_errors = True)
+    calls = [dysco_call(msin, dysco) for msin, dysco in zip(mslist, dyscos)]
+    pool = start_pool(len(calls), threads)
+    # Calls that did not start yet are skipped once the archive failed
+    failed = threading.Event()
+    def dysco_pass(call):
+        if failed.is_set():
+            return None
+        return run_command(call, log, 'compress')
+    # imap starts all calls now and hands the results back in order
+    dppp = pool.imap(dysco_pass, calls)
+
+    if find_executable('pigz'):
+        compress = ['pigz', '-1', '-p', str(threads)]
     else:
-        print('not implemented')
+        print('pigz not found, compressing with gzip on a single core')
+        compress = ['gzip', '-1']
+    manifest = {}
+    # Written under another name, so a failed or interrupted run never
+    # leaves something that looks like a finished archive
+    part = '{}.part'.format(out)
+    try:
+        with open(part, 'wb') as handle:
+            zipper = subprocess.Popen(compress, stdin = subprocess.PIPE, stdout = handle)
+            try:
+                with tarfile.open(fileobj = zipper.stdin, mode = 'w|') as tar:
+                    for msin, ms_name in zip(mslist, names):
+                        target = instrument_dir('{}/'.format(top), ms_name, len(mslist))
+                        for inst in sorted(filter(lambda x: 'instrument' in x, os.listdir(msin))):
+                            add_tree(tar, '{0}{1}'.format(msin, inst), '{0}{1}'.format(target, inst), manifest)
+                    add_tree(tar, 'models', '{}/models'.format(top), manifest)
+                    for cal in sorted(filter(lambda x: 'cal' in x or x == 'init', os.listdir(rname))):
+                        model = '{0}{1}/ws-MFS-model.fits'.format(rname, cal)
+                        if os.path.isfile(model):
+                            add_tree(tar, model, '{0}/models/{1}-model.fits'.format(top, cal), manifest)
+                        else:
+                            print('Missing: {}'.format(model))
+                    if os.path.isdir('{}lastrun'.format(rname)):
+                        add_tree(tar, '{}lastrun'.format(rname), '{}/lastrun'.format(top), manifest)
+                    for msin, ms_name, dysco, code in zip(mslist, names, dyscos, dppp):
+                        if code:
+                            raise RuntimeError('DPPP failed to compress {}'.format(msin))
+                        add_tree(tar, dysco, '{0}/{1}'.format(top, ms_name), manifest)
+                        shutil.rmtree(dysco, ignore_errors = True)
+                    # Last, so it has the records of the DPPP passes above
+                    if os.path.isfile('{}log'.format(rname)):
+                        add_tree(tar, '{}log'.format(rname), '{}/log'.format(top), manifest)
+                    data = json.dumps(manifest, indent = 1, sort_keys = True).encode()
+                    info = tarfile.TarInfo('{}/MANIFEST.json'.format(top))
+                    info.size = len(data)
+                    info.mtime = time.time()
+                    tar.addfile(info, io.BytesIO(data))
+            except BaseException:
+                failed.set()
+                raise
+            finally:
+                # The DPPP passes that are still running write to the
+                # dysco folders, which are only removed when they are done
+                pool.close()
+                pool.join()
+                zipper.stdin.close()
+                zipper.wait()
+                for dysco in dyscos:
+                    shutil.rmtree(dysco, ignore_errors = True)
+        if zipper.returncode:
+            raise RuntimeError('{0} failed writing {1}'.format(compress[0], part))
+    except BaseException:
+        if os.path.isfile(part):
+            os.remove(part)
+        raise
+    os.rename(part, out)
+    with open('{}.manifest.json'.format(out), 'w') as handle:
+        json.dump(manifest, handle, indent = 1, sort_keys = True)
+    total = sum(entry['size'] for entry in manifest.values())
+    print('Archived {0} files ({1:.2f} GB) to {2}, {3:.2f} GB compressed'.format(len(manifest), total/1024.**3,
+          out, os.path.getsize(out)/1024.**3))
+
+def last_calibration(rname, ms_name):
+    '''
+        The last calibration step (e.g. 'd3') the journal of the run records
+        for ms_name, None for runs without a journal
+    '''
+    if not os.path.isfile('{}log'.format(rname)):
+        return None
+    last = None
+    for record in jp.Locker('{}log'.format(rname)).query():
+        step = record.get('step') or ''
+        ms = record.get('ms')
+        if re.match(r'^[{}]\d+$'.format(''.join(CALIBRATIONS)), step) and (ms is None or os.path.basename(ms.rstrip('/')) == ms_name):
+            last = step
+    return last
+
+def guess_calibration(folder):
+    '''
+        The calibration step from the names of the instruments in folder,
+        for archives made before the journal was kept. Steps are numbered
+        per kind, so the last one is that of the newest h5parm.
+    '''
+    steps = {}
+    for name in os.listdir(folder):
+        match = re.match(r'^instrument_?(tp|t|a|p)?(\d*)\.h5$', name)
+        if match:
+            kind = {'tp': 'a', 't': 't', 'a': 'd', 'p': 'd', None: 'p'}[match.group(1)]
+            step = '{0}{1}'.format(kind, int(match.group(2) or 0))
+            steps[step] = max(steps.get(step, 0), os.path.getmtime(folder + name))
+    if not steps:
+        return None
+    newest = max(steps.values())
+    last = [step for step, mtime in steps.items() if mtime > newest - 1.]
+    if len(last) > 1:
+        raise IOError('Cannot tell which of {0} in {1} was the last calibration'.format(', '.join(sorted(last)), folder))
+    return last[0]
+
+def calibration(step):
+    '''
+        Image folder, [(h5parm, corrections)] and output column of a step
+    '''
+    kind, n = step[0], int(step[1:])
+    image, h5parms, column = CALIBRATIONS[kind]
+    if n == 0 and kind in 'pd':
+        image = 'init'
+    if n == 0 and kind == 'p':
+        h5parms = [('instrument.h5', ['phase000'])]
+    return image.format(n), [(h5.format(n), corrections) for h5, corrections in h5parms], column
+
+def restore_calls(rname, ms_name, nms):
+    '''
+        The predict and the single DPPP pass with all applycals that bring
+        ms_name back to the state at the end of the run
+    '''
+    folders = [instrument_dir(rname, ms_name, nms), '{}instruments/'.format(rname), '{}lastrun/'.format(rname)]
+    folders = [folder for folder in folders if os.path.isdir(folder)]
+    step = last_calibration(rname, ms_name)
+    if step is None:
+        for folder in folders:
+            step = guess_calibration(folder)
+            if step:
+                break
+    if step is None:
+        raise IOError('No calibration found for {}'.format(ms_name))
+    image, h5parms, column = calibration(step)
+
+    # The model of the step, or the one put in lastrun by hand
+    model = '{0}models/{1}'.format(rname, image)
+    if not os.path.isfile('{}-model.fits'.format(model)):
+        lastrun = list(filter(lambda x: x.endswith('-model.fits'), os.listdir('{}lastrun/'.format(rname))))
+        if not lastrun:
+            raise IOError('No model found for {0} of {1}'.format(step, ms_name))
+        model = '{0}lastrun/{1}'.format(rname, lastrun[0][:-len('-model.fits')])
+    calls = ['wsclean -predict -name {0} {1}{2}'.format(model, rname, ms_name)]
+
+    steps = []
+    acal = ['DPPP', 'msin={0}{1}'.format(rname, ms_name), 'msin.datacolumn=DATA', 'msout=.',
+            'msout.datacolumn={}'.format(column), 'msout.storagemanager=dysco']
+    for h5, corrections in h5parms:
+        parmdb = [folder + h5 for folder in folders if os.path.isfile(folder + h5)]
+        if not parmdb:
+            raise IOError('Missing {0} for {1}'.format(h5, ms_name))
+        for correction in corrections:
+            name = 'applycal{}'.format(len(steps) + 1)
+            steps.append(name)
+            acal += ['{}.type=applycal'.format(name), '{0}.parmdb={1}'.format(name, parmdb[0]),
+                     '{0}.correction={1}'.format(name, correction)]
+    acal.append('steps=[{}]'.format(','.join(steps)))
+    calls.append(' '.join(acal))
+    return calls
+
+def uncompress(rname, threads = None):
+    '''
+        Restores every ms of an unpacked run in parallel: the model of the
+        last calibration is predicted and its solutions are applied in one
+        DPPP pass
+    '''
+    assert rname[-1] == '/'
+    names = [os.path.basename(ms.rstrip('/')) for ms in find_ms(rname)]
+    if not names:
+        raise IOError('No measurement sets in {}'.format(rname))
+    # Read the journal before the restore calls are added to it
+    calls = [restore_calls(rname, ms_name, len(names)) for ms_name in names]
+    log = jp.Locker('{}log'.format(rname))
+
+    def restore(args):
+        ms_name, mscalls = args
+        for call in mscalls:
+            print(call)
+            if run_command(call, log, 'restore', '{0}{1}/'.format(rname, ms_name)):
+                return 'Failed: {}'.format(call)
+
+    pool = start_pool(len(names), threads)
+    try:
+        failed = [result for result in pool.map(restore, zip(names, calls)) if result]
+    finally:
+        pool.close()
+        pool.join()
+    for result in failed:
+        print(result)
+    print('Restored {0} of {1} measurement set(s)'.format(len(names) - len(failed), len(names)))
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('-r', help = 'location of the run')
-    parser.add_argument('-ms', help = 'which measurement set to use', default = '.')
+    parser.add_argument('-ms', help = 'which measurement set to use, or a folder with all measurement sets of the run', default = '.')
     parser.add_argument('-d', action = 'store_true', help = 'Decompresses set')
+    parser.add_argument('-a', action = 'store_true', help = 'Archives the run into a single compressed tarball')
+    parser.add_argument('-o', help = 'Name of the archive (default: <run>.tar.gz)', default = None)
+    parser.add_argument('-j', type = int, help = 'Threads (default: all cores)', default = None)
     parsed = parser.parse_args()
 
     if parsed.d:
-        uncompress_diag(parsed.r)
+        uncompress(parsed.r, parsed.j)
+    elif parsed.a:
+        archive_run(parsed.r, parsed.ms, parsed.o, parsed.j)
     else:
-        close_run(parsed.r, parsed.ms)
+        close_run(parsed.r, parsed.ms, parsed.j)
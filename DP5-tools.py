@@ -7,6 +7,8 @@ import argparse
 import shutil
 import subprocess
 import re
+import journal_pickling as jp
+import staging as st
 
 def init_folder(fname):
     assert fname[-1] == '/'
@@ -37,10 +39,8 @@ def copy_images(rname):
     assert rname[-1] == '/'
     shutil.copytree('runs/{}IMAGES'.format(rname), 'images/{}'.format(rname))
 
-def execute_run(rname, noms = False, nocompress = False, savesky = False, multims = False):
+def execute_run(rname, noms = False, nocompress = False, savesky = False, multims = False, stage = 'auto', verify = False):
     assert rname[-1] == '/'
-    if multims:
-        nocompress = True
     executefile = '{}parsets/execute'.format(rname)
     execlist = []
     with open(executefile, 'r') as handle:
@@ -51,8 +51,8 @@ def execute_run(rname, noms = False, nocompress = False, savesky = False, multim
     if len(modellist) != 1:
         raise IOError('There should only be one model available, otherwise we can\'t autorun DP5')
     else:
-        # Copy measurements folder
-        shutil.copytree('measurements/', '{}/measurements/'.format(rname))
+        # Bring the measurements into the run, cloned where the filesystem can
+        st.stage_tree('measurements/', '{}/measurements/'.format(rname), stage, verify = verify)
         for ms in mslist:
             os.mkdir('{0}/measurements/{1}/losoto'.format(rname,ms))
         # Run DP5.py
@@ -79,11 +79,10 @@ def execute_run(rname, noms = False, nocompress = False, savesky = False, multim
             fulimg +=  ' '.join(ms_appendices)
             subprocess.call(fulimg, shell = True)
             shutil.copyfile('{}/noms/ws-MFS-image.fits'.format(rname), '{}/IMAGES/noms.fits'.format(rname))
-        # Run DP5-compress
-        # Does not (fully) support multi-ms runs yet
+        # Run DP5-compress on all measurement sets of the run
         if not nocompress:
             print('==== RUNNING DP5-COMPRESS')
-            subprocess.call('DP5-compress.py -ms {1}/measurements/{0}/ -r {1}'.format(mslist[0],rname), shell = True)
+            subprocess.call('DP5-compress.py -ms {0}/measurements/ -r {0}'.format(rname), shell = True)
         # Remove instruments
         print('==== REMOVING INSTRUMENTS')
         '''
@@ -97,12 +96,43 @@ def execute_run(rname, noms = False, nocompress = False, savesky = False, multim
         # copy images
         print('==== COPYING IMAGES')
         run_name_nopref = re.sub(r'.*/','/',rname.rstrip('/'))
-        os.mkdir('images/{}'.format(run_name_nopref))
+        if not os.path.isdir('images/{}'.format(run_name_nopref)):
+            os.mkdir('images/{}'.format(run_name_nopref))
         imgs = os.listdir('{}IMAGES'.format(rname))
         imgs_old = ['{0}IMAGES/{1}'.format(rname, img) for img in imgs]
         imgs_new = ['images/{0}/{1}'.format(run_name_nopref, img) for img in imgs]
-        for old,new in zip(imgs_old, imgs_new):
-            shutil.copyfile(old,new)
+        # Only the images that changed since an earlier copy
+        pairs = [(old, new) for old, new in zip(imgs_old, imgs_new) if st.updated(old, new)]
+        st.stage_files(pairs, 'copy', verify = verify, label = 'Copying images')
+
+def profile_run(rname):
+    '''
+        Summarises the journalled calls of a run per step and tool, sorted
+        by wall time, so it is clear where the hours of a reduction go
+    '''
+    assert rname[-1] == '/'
+    log = jp.Locker('{}log'.format(rname))
+    totals = {}
+    for record in log.query():
+        if 'wall' not in record:
+            continue
+        key = (record.get('step') or '-', record.get('tool') or '-')
+        entry = totals.setdefault(key, {'calls': 0, 'failed': 0, 'wall': 0., 'cpu': 0., 'rss': 0})
+        entry['calls'] += 1
+        entry['failed'] += 1 if record.get('exitcode') else 0
+        entry['wall'] += record['wall']
+        entry['cpu'] += record.get('user', 0.) + record.get('sys', 0.)
+        entry['rss'] = max(entry['rss'], record.get('peak_rss', 0), record.get('maxrss', 0))
+    if not totals:
+        print('No timed calls in {}log'.format(rname))
+        return
+    wall = sum(entry['wall'] for entry in totals.values())
+    print('{0:<8}{1:<14}{2:>7}{3:>8}{4:>11}{5:>11}{6:>7}{7:>10}'.format('step', 'tool', 'calls', 'failed', 'wall (h)', 'cpu (h)', 'wall%', 'rss (GB)'))
+    for key, entry in sorted(totals.items(), key = lambda x: x[1]['wall'], reverse = True):
+        print('{0:<8}{1:<14}{2:>7}{3:>8}{4:>11.2f}{5:>11.2f}{6:>7.1f}{7:>10.2f}'.format(key[0], key[1], entry['calls'], entry['failed'],
+              entry['wall']/3600., entry['cpu']/3600., 100*entry['wall']/max(wall, 1e-9), entry['rss']/1024.**3))
+    print('{0:<22}{1:>7}{2:>8}{3:>11.2f}{4:>11.2f}'.format('total', sum(e['calls'] for e in totals.values()),
+          sum(e['failed'] for e in totals.values()), wall/3600., sum(e['cpu'] for e in totals.values())/3600.))
 
 def main():
     parser = argparse.ArgumentParser()
@@ -112,6 +142,8 @@ def main():
     parser.add_argument('-no-compress', help = "Don't run DP5-compress afterwards",action = 'store_true', dest = 'nocomp')
     parser.add_argument('-save-sources', help = "Saves a skymodel afterwards", action = 'store_true', dest = 'savesky')
     parser.add_argument('-multi-ms', help = "Run with multi measurement sets", action = 'store_true', dest = 'multims')
+    parser.add_argument('-stage', help = "How measurement sets are brought into a run: auto (reflink if possible, else copy), reflink, copy or hardlink. Hard links share the data with measurements/, which the reduction changes in place", choices = st.MODES, default = 'auto')
+    parser.add_argument('-verify', help = "Compare checksums of all staged files with the originals", action = 'store_true')
     parsed = parser.parse_args()
 
     step = parsed.step
@@ -135,6 +167,8 @@ def main():
                            |  just makes your life easier
                 execute    |  Execute the parameters that are loaded in parsets/
                            |  execute
+                profile    |  Summarise the time, cpu and memory of all calls
+                           |  of a run, per step and tool. Needs the run folder
                 help       |  Print this message
         ''')
     elif step == 'init':
@@ -146,7 +180,9 @@ def main():
     elif step == 'copyimg':
         copy_images(fname)
     elif step == 'execute':
-        execute_run(fname,parsed.noms,parsed.nocomp,parsed.savesky, parsed.multims)
+        execute_run(fname,parsed.noms,parsed.nocomp,parsed.savesky, parsed.multims, parsed.stage, parsed.verify)
+    elif step == 'profile':
+        profile_run(fname)
     else:
         raise NotImplementedError
     
@@ -16,16 +16,33 @@ import reduction_steps.l2c as lc
 import datetime
 import quality_check as qc
 import multiprocessing as mp
+import scheduler as sc
+import resources as rs
+import reorder as ro
+import planner as pl
 
 class FakeParser(object):
-    def __init__(self, ms, p, s, d, y, m, multi):
+    def __init__(self, ms, p, s, y, m, multi, jobs = 1, cores = None, memory = None, task_mem = None, min_threads = 4, resume = False, cache = None, cache_quota = None, backup = False, fused = False, scratch = None, rms_region = None, plan = None, plan_from = ()):
         self.ms = ms
         self.p = p
         self.s = s
-        self.d = d
         self.y = y
         self.m = m
         self.multims = multi
+        self.jobs = jobs
+        self.cores = cores
+        self.memory = memory
+        self.task_mem = task_mem
+        self.min_threads = min_threads
+        self.resume = resume
+        self.cache = cache
+        self.cache_quota = cache_quota
+        self.backup = backup
+        self.fused = fused
+        self.scratch = scratch
+        self.rms_region = rms_region
+        self.plan = plan
+        self.plan_from = plan_from
 
 def executeCalibration(cal):
     cal.calibrate()
@@ -34,6 +51,90 @@ def executePredict(cal):
     cal.initialize()
     cal.execute()
 
+def executeStage(cal, stage):
+    getattr(cal, stage)()
+
+def executeImage(cal, mslist):
+    if hasattr(cal, 'run_img'):
+        cal.run_img(mslist)
+    else:
+        imgcall = cal.prep_img()
+        imgcall += ' '.join(mslist)
+        cal.pickle_and_call(imgcall, True)
+
+def executePhaseUp(cal):
+    cal.initialize()
+    cal.execute()
+
+def done_marker(ms, step, stage):
+    '''
+        Marker file of a task that changes ms in place, see sc.Checkpoint
+    '''
+    return '{0}{1}_{2}.done'.format(ms, step, stage)
+
+def build_graph(parsed, cwd, redsteps, nlist, mslist, global_threads = None):
+    '''
+        Compiles the reduction string into a task graph. Per ms, every step
+        waits for the previous step that changed that ms, so a solve only
+        needs the image (and model) of the step before it. Imaging waits
+        for all ms of its step, plots only for their own solutions, and
+        the destructive phase-up of a ms waits for everything that reads it.
+        Imaging only overlaps with (single threaded) plotting, so it gets
+        global_threads instead of the per-worker budget.
+    '''
+    pset_loc = '{}/parsets/'.format(cwd)
+    graph = sc.TaskGraph()
+    last = {ms: [] for ms in mslist}     # last task that changed each ms
+    readers = {ms: [] for ms in mslist}  # tasks that only read from it
+    for red, n in zip(redsteps, nlist):
+        n = int(n)
+        step = '{0}{1}'.format(red, n)
+        if red in 'pdta':
+            applies = []
+            for ms in mslist:
+                if red == 'p':
+                    cal = pc.PhaseCalibrator(n, ms, parsed.p, pset_loc)
+                elif red == 'd':
+                    cal = dc.DiagonalCalibrator(n, ms, parsed.p, pset_loc)
+                elif red == 't':
+                    cal = tc.TecCalibrator(n, ms, parsed.p, pset_loc)
+                else:
+                    cal = tp.TecPhaseCalibrator(n, ms, parsed.p, pset_loc)
+                if parsed.fused:
+                    solve = graph.add('{0}:solve:{1}'.format(step, ms), executeStage, (cal, 'solve_apply'), last[ms], ms, step, outputs = cal.artefacts('solve'),
+                                      markers = [done_marker(ms, step, 'apply')])
+                    apply = solve
+                else:
+                    solve = graph.add('{0}:solve:{1}'.format(step, ms), executeStage, (cal, 'solve'), last[ms], ms, step, outputs = cal.artefacts('solve'))
+                    apply = graph.add('{0}:apply:{1}'.format(step, ms), executeStage, (cal, 'apply'), [solve], ms, step, markers = [done_marker(ms, step, 'apply')])
+                if hasattr(cal, 'plot'):
+                    # Plots only read the solutions
+                    plot = graph.add('{0}:plot:{1}'.format(step, ms), executeStage, (cal, 'plot'), [solve], ms, step, outputs = cal.artefacts('plot'))
+                    readers[ms].append(plot)
+                applies.append(apply)
+            image = graph.add('{}:image'.format(step), executeImage, (cal, mslist), applies, None, step, threads = global_threads, outputs = cal.artefacts('image'))
+            for ms in mslist:
+                last[ms] = [image]
+        elif red == 'u':
+            for ms in mslist:
+                cal = pu.PhaseUp(n, ms, parsed.p, pset_loc, parsed.m, parsed.backup)
+                last[ms] = [graph.add('{0}:phaseup:{1}'.format(step, ms), executePhaseUp, (cal,), last[ms] + readers[ms], ms, step,
+                                      markers = [done_marker(ms, step, 'phaseup')])]
+                readers[ms] = []
+        elif red == 'm':
+            for ms in mslist:
+                cal = pr.Predictor(ms, parsed.m, parsed.p, pset_loc)
+                last[ms] = [graph.add('{0}:predict:{1}'.format(step, ms), executePredict, (cal,), last[ms], ms, step)]
+        elif red == 'l':
+            for ms in mslist:
+                cal = lc.LinToCirc(n, ms, parsed.p, pset_loc, parsed.jobs)
+                # The row ranges get their own worker processes, which the
+                # (daemonic) pool workers are not allowed to start
+                last[ms] = [graph.add('{0}:lin2circ:{1}'.format(step, ms), executeCalibration, (cal,), last[ms], ms, step, parsed.jobs > 1)]
+        else:
+            print("Reduction step {} not implemented".format(red))
+    return graph
+
 def main(parsed, cwd):
     os.environ['OMP_NUM_THREADS']= '1'
     if parsed.s == 'h':
@@ -59,7 +160,7 @@ def main(parsed, cwd):
         mask = chara == np.asarray(redsteps)
         nlist[mask] = np.arange(1, int(1+sum(mask)))
 
-    if 'u' in redsteps and not parsed.y:
+    if 'u' in redsteps and not parsed.backup and not parsed.y and not parsed.plan:
         print("This reduction strings contains a phase-up. Phase-ups are destructive - so please make sure that you have backed your system up. Type 'ok' to continue: ")
         ans = raw_input()
         if ans != 'ok':
@@ -70,62 +171,55 @@ def main(parsed, cwd):
 
     # Load all ms
     if parsed.multims:
-        mslist = [parsed.ms+ms+'/' for ms in os.listdir(parsed.ms)]
+        # Leaving out the backups and leftovers of phase-ups
+        mslist = [parsed.ms+ms+'/' for ms in os.listdir(parsed.ms) if not ms.endswith(('_prepu', '_pu', '.copying'))]
     else:
         mslist = [parsed.ms]
 
-    pool = mp.Pool(4) # Maybe make this a function or something?
+    # Read by cache.cached_call in the workers
+    if parsed.cache:
+        os.environ['DP5_CACHE'] = os.path.abspath(parsed.cache)
+        if parsed.cache_quota:
+            os.environ['DP5_CACHE_QUOTA'] = str(parsed.cache_quota)
+    # Read by reorder.ReorderCache
+    if parsed.scratch:
+        os.environ['DP5_SCRATCH'] = os.path.abspath(parsed.scratch)
+
+    memory = parsed.memory*rs.GB if parsed.memory else None
+    task_mem = parsed.task_mem*rs.GB if parsed.task_mem else None
+    resources = rs.ResourceManager(parsed.cores, memory, parsed.min_threads)
+    nworkers = resources.workers(len(mslist), task_mem)
+    resources.export(nworkers)
+    graph = build_graph(parsed, cwd, redsteps, nlist, mslist, resources.cores - nworkers + 1)
+    if parsed.plan:
+        # Dry run: only write down what would be done
+        result = pl.plan(graph, [parsed.p + 'log'] + list(parsed.plan_from), nworkers)
+        result.update({'reduction': parsed.s, 'ms': mslist})
+        pl.write_plan(result, parsed.plan)
+        pl.print_plan(result)
+        print('==== Plan written to {0}.json and {0}.sh'.format(parsed.plan))
+        return
+    pool = mp.Pool(nworkers)
     # Perform the reductions
-    # TODO: need to fix all the necessary reductions, at least 'd' and 'm'
-    for red, n in zip(redsteps, nlist):
-        n = int(n)
-        if red == 'p':
-            callist = [pc.PhaseCalibrator(n,ms,parsed.p, '{}/parsets/'.format(cwd)) for ms in mslist]
-            pool.map(executeCalibration, callist)
-            imgcall = callist[0].prep_img()
-            imgcall += ' '.join(mslist)
-            callist[0].pickle_and_call(imgcall)
-        elif red == 'd':
-            callist = [dc.DiagonalCalibrator(n, ms, parsed.p, '{}/parsets/'.format(cwd)) for ms in mslist]
-            pool.map(executeCalibration, callist)
-            callist[0].run_img(mslist)
-        elif red == 't':
-            callist = [tc.TecCalibrator(n, ms, parsed.p, '{}/parsets/'.format(cwd)) for ms in mslist]
-            pool.map(executeCalibration, callist)
-            imgcall = callist[0].prep_img()
-            imgcall += ' '.join(mslist)
-            callist[0].pickle_and_call(imgcall)
-        elif red == 'u':
-            for ms in mslist:
-                cal = pu.PhaseUp(n, ms, parsed.p, '{}/parsets/'.format(cwd), parsed.m)
-                cal.initialize()
-                cal.execute()
-        elif red == 'm':
-            callist = [pr.Predictor(ms, parsed.m, parsed.p, '{}/parsets/'.format(cwd)) for ms in mslist]
-            pool.map(executePredict, callist)
-        elif red == 'a':
-            callist=[tp.TecPhaseCalibrator(n, ms, parsed.p, '{}/parsets/'.format(cwd)) for ms in mslist]
-            pool.map(executeCalibration, callist)
-            imgcall = callist[0].prep_img()
-            imgcall += ' '.join(mslist)
-            callist[0].pickle_and_call(imgcall)
-        elif red == 'l':
-            callist = [lc.LinToCirc(n,ms,parsed.p,'{}/parsets/'.format(cwd)) for ms in mslist]
-            pool.map(executeCalibration, callist)
-        else:
-            print("Reduction step {} not implemented".format(red))
-        if parsed.d:
-            cal.DEBUG = True
-        #if not parsed.multims:
-        #    cal.initialize()
-        #    cal.execute()
+    checkpoint = sc.Checkpoint(parsed.p + 'checkpoint', parsed.resume)
+    try:
+        graph.run(pool, checkpoint = checkpoint)
+    finally:
+        pool.close()
+        pool.join()
+        log = jp.Locker(parsed.p + 'log')
+        log['task_timings'] = graph.timings
+    # Kept after a failure, so a -resume can still reuse the reordered data
+    ro.ReorderCache(parsed.p).clear()
 
-    qc.main(parsed.p, redsteps, nlist)
+    if parsed.rms_region:
+        qc.main(parsed.p, redsteps, nlist, tuple(parsed.rms_region[:2]), parsed.rms_region[2])
+    else:
+        qc.main(parsed.p, redsteps, nlist)
 
     log = jp.Locker(parsed.p + 'log')
     log['ms'] = parsed.ms
     log['last_edit'] = datetime.datetime.now().strftime("%Y_%m_%d_%H_$M")
-    log.save()
 
 
 if __name__ == '__main__':
@@ -133,11 +227,24 @@ if __name__ == '__main__':
     parser.add_argument('-p', type = str, help = "Path to where we can write the images and solution plots", default = './RESULTS/')
     parser.add_argument('-ms', type = str, help = "Location of measurement set", required = True)
     parser.add_argument('-s', type = str, help = "String representing the reduction steps. Use h for more help", required = True)
-    parser.add_argument('-d', action = 'store_true', help = 'Enables debug mode')
     parser.add_argument('-y', action = 'store_true', help = 'Automatically accept phase-up warning')
     parser.add_argument('-m', type = str, help = "Path to the location of a model FITS file, used whenever we need to predict the model", default = None)
     parser.add_argument('-path_wd', action = 'store_true', help = argparse.SUPPRESS)
     parser.add_argument('-multims', action = 'store_true', help="Enable multiple ms to be read. This will change ms to be the root folder now.")
+    parser.add_argument('-jobs', type = int, help = "Number of processes used to convert row ranges of a single ms in lin2circ (step l)", default = 1)
+    parser.add_argument('-cores', type = int, help = "Number of cores the run may use. Defaults to all cores of the machine", default = None)
+    parser.add_argument('-memory', type = float, help = "Memory (GB) the run may use. Defaults to all memory of the machine", default = None)
+    parser.add_argument('-task_mem', type = float, help = "Memory (GB) a single calibration of one ms needs; limits the number of workers", default = None)
+    parser.add_argument('-resume', action = 'store_true', help = "Skip the steps that finished in an earlier, interrupted run with the same reduction string")
+    parser.add_argument('-cache', type = str, help = "Folder of a cache of h5parms and images, shared between runs. Identical solves/images on identical data are restored from it instead of rerun", default = None)
+    parser.add_argument('-cache_quota', type = float, help = "Maximum size (GB) of the cache; least recently used entries are removed first", default = None)
+    parser.add_argument('-backup', action = 'store_true', help = "Keep the ms from before a phase-up as <ms>_prepu. Without it phase-ups are destructive")
+    parser.add_argument('-fused', action = 'store_true', help = "Let DDECal apply its own solutions (ddecal.applysolution), so every calibration reads and writes the ms once instead of twice")
+    parser.add_argument('-scratch', type = str, help = "Fast local folder for the reordered visibilities wsclean keeps between the imaging and predict of a step. Defaults to the run folder", default = None)
+    parser.add_argument('-rms_region', type = int, nargs = 3, help = "Centre x, y and radius in pixels of the disc in which the quality check measures the rms", default = None)
+    parser.add_argument('-plan', type = str, help = "Do not run anything, but write the calls of the run with I/O and runtime estimates to <PLAN>.json and <PLAN>.sh", default = None)
+    parser.add_argument('-plan_from', type = str, nargs = '+', help = "Journals (log files) of earlier runs to take the runtimes of calls from, next to the one of this run", default = [])
+    parser.add_argument('-min_threads', type = int, help = "Least number of threads every DPPP/wsclean call gets; limits the number of workers", default = 4)
 
     parsed = parser.parse_args()
     if parsed.path_wd:
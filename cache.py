@@ -0,0 +1,187 @@
+from __future__ import print_function
+import os
+import re
+import glob
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+
+'''
+    Opt-in cache for the artefacts of DPPP solves and wsclean images. The key
+    of a call is a hash of the command (with run specific paths and thread
+    counts taken out) and a fingerprint of everything it reads. A hit copies
+    the stored h5parms/images into place instead of running the call.
+
+    The cache is enabled by pointing DP5_CACHE at a directory. DP5_CACHE_QUOTA
+    (GB) bounds its size, the least recently used entries are evicted first.
+'''
+
+SAMPLE = 1024**2
+
+def fingerprint_file(fname, sample = SAMPLE):
+    '''
+        Size plus the first, middle and last sample bytes of a file. Cheap
+        for multi-GB files, and unlike the mtime it survives a copy.
+    '''
+    size = os.path.getsize(fname)
+    digest = hashlib.sha1(str(size).encode())
+    with open(fname, 'rb') as handle:
+        for offset in sorted(set([0, max(0, size//2 - sample//2), max(0, size - sample)])):
+            handle.seek(offset)
+            digest.update(handle.read(sample))
+    return digest.hexdigest()
+
+def fingerprint_ms(ms, sample = SAMPLE):
+    '''
+        Fingerprint of the storage files of the main table of a ms. Any
+        column written in between (e.g. a new MODEL_DATA) changes it.
+    '''
+    digest = hashlib.sha1()
+    for fname in sorted(os.listdir(ms)):
+        if fname.startswith('table.'):
+            digest.update(fname.encode())
+            digest.update(fingerprint_file(os.path.join(ms, fname), sample).encode())
+    return digest.hexdigest()
+
+def _size(path):
+    total = 0
+    for root, dirs, files in os.walk(path):
+        total += sum(os.path.getsize(os.path.join(root, fname)) for fname in files)
+    return total
+
+class ArtefactCache(object):
+    def __init__(self, root, quota = None):
+        '''
+            quota is the maximum size of the cache in bytes
+        '''
+        self.root = root
+        self.quota = quota
+        try:
+            os.makedirs(root)
+        except OSError:
+            if not os.path.isdir(root):
+                raise
+
+    def key(self, call, inputs = (), prefixes = ()):
+        '''
+            inputs are measurement sets or files the call reads, prefixes
+            are other run specific paths (e.g. the run folder). All of them
+            are replaced by placeholders, so the same call in a copied run
+            has the same key.
+        '''
+        generic = re.sub(r'(?<=\s)numthreads=\d+|(?<=\s)-j\s+\d+', '', call)
+        labels = [(path.rstrip('/'), '<in{}>'.format(i)) for i, path in enumerate(inputs)]
+        labels += [(path.rstrip('/'), '<p{}>'.format(i)) for i, path in enumerate(prefixes)]
+        # Longest first, so a run folder does not clobber the ms inside it
+        for path, label in sorted(labels, key = lambda x: len(x[0]), reverse = True):
+            if path:
+                generic = generic.replace(path, label)
+        digest = hashlib.sha1(' '.join(generic.split()).encode())
+        for path in inputs:
+            if os.path.isdir(path):
+                digest.update(fingerprint_ms(path).encode())
+            else:
+                digest.update(fingerprint_file(path).encode())
+        return digest.hexdigest()
+
+    def restore(self, key, outputs):
+        '''
+            Copies a stored entry to the outputs. Returns False on a miss.
+        '''
+        entry = os.path.join(self.root, key)
+        try:
+            with open(os.path.join(entry, 'meta.json'), 'r') as handle:
+                meta = json.load(handle)
+            for stored, i, basename in meta['files']:
+                shutil.copy2(os.path.join(entry, stored), os.path.join(os.path.dirname(outputs[i]), basename))
+            os.utime(os.path.join(entry, 'meta.json'), None)
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+        return True
+
+    def store(self, key, outputs):
+        '''
+            Stores the files matching outputs (paths or glob patterns)
+            under key. Entries are written aside and renamed into place,
+            so concurrent workers never see half an entry.
+        '''
+        files = []
+        for i, pattern in enumerate(outputs):
+            files += [(i, fname) for fname in sorted(glob.glob(pattern)) if os.path.isfile(fname)]
+        if not files or os.path.isdir(os.path.join(self.root, key)):
+            return
+        tmp = tempfile.mkdtemp(dir = self.root, prefix = '.incoming')
+        meta = {'time': time.time(), 'files': []}
+        for n, (i, fname) in enumerate(files):
+            stored = '{0:04d}_{1}'.format(n, os.path.basename(fname))
+            shutil.copy2(fname, os.path.join(tmp, stored))
+            meta['files'].append((stored, i, os.path.basename(fname)))
+        with open(os.path.join(tmp, 'meta.json'), 'w') as handle:
+            json.dump(meta, handle)
+        try:
+            os.rename(tmp, os.path.join(self.root, key))
+        except OSError:
+            shutil.rmtree(tmp)
+        self.evict()
+
+    def evict(self):
+        '''
+            Removes the least recently used entries until the cache fits the quota
+        '''
+        if not self.quota:
+            return
+        entries = []
+        for key in os.listdir(self.root):
+            meta = os.path.join(self.root, key, 'meta.json')
+            if os.path.isfile(meta):
+                entries.append((os.path.getmtime(meta), _size(os.path.join(self.root, key)), key))
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, key in sorted(entries):
+            if total <= self.quota:
+                break
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors = True)
+            total -= size
+
+def from_environment():
+    root = os.environ.get('DP5_CACHE')
+    if not root:
+        return None
+    quota = os.environ.get('DP5_CACHE_QUOTA')
+    return ArtefactCache(root, float(quota)*1024**3 if quota else None)
+
+def cached_call(call, outputs, runner, inputs = (), prefixes = (), log = None):
+    '''
+        Runs call through runner (a pickle_and_call), unless the cache is
+        enabled and already holds the outputs of an identical call on
+        identical inputs. outputs are paths or glob patterns of the files
+        the call creates; they are stored after a successful run.
+    '''
+    cache = from_environment()
+    if cache is None:
+        return runner(call)
+    key = cache.key(call, inputs, prefixes)
+    if cache.restore(key, outputs):
+        print('==== Restored {0} from the cache ({1})'.format(', '.join(outputs), key))
+        if log is not None:
+            log.add_calls('cache hit {0}: {1}'.format(key, call))
+        return 0
+    ret = runner(call)
+    if not ret:
+        cache.store(key, outputs)
+    return ret
+
+def cached_fused_call(solve, fused, apply, outputs, runner, inputs = (), prefixes = (), log = None):
+    '''
+        Runs fused, a call that solves and applies in one pass, unless the
+        cache holds the outputs of solve. Then only apply runs.
+    '''
+    ran = []
+    def run_fused(call):
+        ran.append(call)
+        return runner(fused)
+    ret = cached_call(solve, outputs, run_fused, inputs, prefixes, log)
+    if not ran:
+        ret = runner(apply)
+    return ret
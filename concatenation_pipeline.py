@@ -2,48 +2,42 @@
 import DP5 as run
 import numpy as np
 import os
-import reduction_steps.lin2circ as lc
+import lin2circ as lc
 import argparse
-import multiprocessing as mp
-import subprocess
+import resources as rs
+import executors as ex
+import journal_pickling as jp
+from runner import run_command
 
-class FakeOptionParserL2C(object):
-    def __init__(self, inms='', column='DATA', outcol='DATA_CIRC', poltable=False, back=False, lincol='DATA_LIN'):
-        self.inms = inms
-        self.column = column
-        self.outcol = outcol
-        self.poltable = poltable
-        self.back = back
-        self.lincol = lincol
-
-# Important! check parsets beforehand - so all numthreads are 1
-def average(loc, timestep, freqstep):
+def average(loc, timestep, freqstep, log = None):
     call = 'DPPP msin={0} msout={0}AVG steps=[applybeam,average] average.timestep={1} average.freqstep={2}'.format(loc, timestep, freqstep)
-    subprocess.call(call, shell = True)
+    if run_command(call, log, 'average', loc):
+        raise RuntimeError('DPPP failed to average {}'.format(loc))
 
 def lin2circ(loc):
     '''
-        Contains both the conversion to circular, as well as copying the 
-        data columns back
+        Converts the DATA column to circular in place, including the
+        POLARIZATION table
     '''
-    FOP = FakeOptionParserL2C(loc)
-    lc.main(FOP)
-    call = 'DPPP msin={0} msout={0}CIR steps=[] msin.datacolumn=DATA_CIR msout.datacolumn=DATA'.format(loc)
-    subprocess.call(call, shell = True)
+    lc.convert_ms(loc, 'lin2circ', 'DATA', 'DATA', corr_type = lc.CORR_TYPES['circular'])
 
 def phaseup_step(loc, model, num, p):
-    fakeparser = run.FakeParser(loc, p+str(num), 'mu', False, True, model)
+    # A run folder per subband, like map_runs.single_reduction
+    rname = os.path.join(p, str(num)) + '/'
+    if not os.path.isdir(rname):
+        os.makedirs(rname)
+    fakeparser = run.FakeParser(loc.rstrip('/') + '/', rname, 'mu', True, model, False)
     run.main(fakeparser, os.getcwd())
 
 def parset_reduction(combo):
     loc, timestep, freqstep, model, p, num = combo
-    average(loc, timestep, freqstep)
+    average(loc, timestep, freqstep, jp.Locker(os.path.join(p, 'log')))
     lin2circ('{}AVG'.format(loc))
 
 def parset_reduction_phaseup(combo):
     loc, timestep, freqstep, model, p, num = combo
     parset_reduction(combo)
-    phaseup_step('{}AVGCIR', model, num, p)
+    phaseup_step('{}AVG'.format(loc), model, num, p)
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Preprocessing pipeline - combines several measurement sets together')
@@ -53,6 +47,9 @@ if __name__ == '__main__':
     parser.add_argument('-t', type = int, help = 'Timestep for averaging')
     parser.add_argument('-f', type = int, help = 'Frequency step for averaging')
     parser.add_argument('-pu', action = 'store_true', help = 'Phase-up each subband afterwards')
+    parser.add_argument('-cores', type = int, help = 'Number of cores to use. Defaults to all cores of the machine', default = None)
+    parser.add_argument('-task_mem', type = float, help = 'Memory (GB) a single subband needs; limits the number of parallel subbands', default = None)
+    ex.add_arguments(parser)
 
     parsed = parser.parse_args()
     assert parsed.r[-1] == '/'
@@ -65,8 +62,14 @@ if __name__ == '__main__':
     for filnum in sorted_list:
         combi_tuples.append((parsed.r+str(filnum), parsed.t, parsed.f, parsed.m, parsed.p, filnum))
     
-    pl = mp.Pool(mp.cpu_count())
+    if not os.path.isdir(parsed.p):
+        os.makedirs(parsed.p)
+    resources = rs.ResourceManager(parsed.cores)
+    nworkers = resources.workers(len(combi_tuples), parsed.task_mem*rs.GB if parsed.task_mem else None)
+    resources.export(nworkers)
+    # Every finished subband is journalled in <p>/log, wherever it ran
+    executor = ex.make_executor(parsed, parsed.p, nworkers, jp.Locker(os.path.join(parsed.p, 'log')))
     if parsed.pu:
-        pl.map(parset_reduction_phaseup, combi_tuples)
+        executor.map(parset_reduction_phaseup, combi_tuples)
     else:
-        pl.map(parset_reduction, combi_tuples)
+        executor.map(parset_reduction, combi_tuples)
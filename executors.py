@@ -0,0 +1,293 @@
+#!/usr/bin/env python2.7
+from __future__ import print_function
+import os
+import sys
+import time
+import pickle
+import socket
+import argparse
+import tempfile
+import importlib
+import traceback
+import subprocess
+import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
+
+'''
+    Where the independent reductions of map_runs.py and
+    concatenation_pipeline.py run. An executor maps a function over a list
+    of arguments like Pool.map and returns the results in order:
+        LocalExecutor   processes on this machine. Unlike the workers of
+                        mp.Pool they are not daemonic, so every task may
+                        start a pool of its own (DP5.main does).
+        BatchExecutor   writes a job array script in which every array task
+                        runs one task, submits it and waits for all of them.
+                        The scheduler is Slurm (sbatch/squeue), or
+                        FakeScheduler, which runs the array tasks as local
+                        processes to test the batch path without a cluster.
+    The batch tasks find the function by module and name, and their
+    arguments and results are pickled in the job folder, which has to be on
+    a filesystem all nodes see. With a log (journal_pickling.Locker) every
+    finished task is journalled centrally with its node and timings.
+
+    A single array task is run by this file:
+        executors.py -job <job folder> -task <index>
+'''
+
+def _task_record(index, start, end, error = None, result = None):
+    return {'index': index, 'host': socket.gethostname(), 'start': start, 'end': end,
+            'wall': end - start, 'error': error, 'result': result}
+
+def _call(func, arg, index):
+    '''
+        Runs a task and returns its record. Exceptions are returned rather
+        than raised, so the executor knows which task failed.
+    '''
+    start = time.time()
+    try:
+        result = func(arg)
+        error = None
+    except Exception:
+        result = None
+        error = traceback.format_exc()
+    return _task_record(index, start, time.time(), error, result)
+
+def _finish(records, name, log = None):
+    '''
+        Journals the tasks and raises a RuntimeError if any of them failed
+    '''
+    failed = []
+    for record in records:
+        if log is not None:
+            log.add_record('task', executor = name, **record)
+        if record['error'] is not None:
+            failed.append(record)
+            print('==== Task {0} failed on {1}:'.format(record['index'], record['host']))
+            print(record['error'])
+    if failed:
+        raise RuntimeError('{0} of {1} task(s) failed, first one: {2}'.format(len(failed), len(records), failed[0]['index']))
+    return [record['result'] for record in records]
+
+class LocalExecutor(object):
+    def __init__(self, nworkers = None, log = None):
+        self.nworkers = nworkers if nworkers else mp.cpu_count()
+        self.log = log
+
+    def _run(self, job):
+        func, arg, index = job
+        receiver, sender = mp.Pipe(False)
+        proc = mp.Process(target = lambda: sender.send(_call(func, arg, index)))
+        start = time.time()
+        proc.start()
+        sender.close()
+        try:
+            record = receiver.recv()
+        except EOFError:
+            # Died without sending anything, e.g. killed for its memory use
+            record = None
+        proc.join()
+        if record is None:
+            record = _task_record(index, start, time.time(), 'Process exited with {}'.format(proc.exitcode))
+        return record
+
+    def map(self, func, tasks):
+        tasks = list(tasks)
+        pool = ThreadPool(max(1, min(self.nworkers, len(tasks))))
+        try:
+            records = pool.map(self._run, [(func, arg, index) for index, arg in enumerate(tasks)], chunksize = 1)
+        finally:
+            pool.close()
+            pool.join()
+        return _finish(records, 'local', self.log)
+
+class Slurm(object):
+    '''
+        Submits job arrays with sbatch and waits for them with squeue
+    '''
+    def __init__(self, poll = 30.):
+        self.poll = poll
+
+    def submit(self, script, ntasks):
+        output = subprocess.check_output(['sbatch', '--parsable', script])
+        return output.decode().strip().split(';')[0]
+
+    def wait(self, jobid):
+        while True:
+            proc = subprocess.Popen(['squeue', '-h', '-j', jobid, '-o', '%i'], stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+            out, err = proc.communicate()
+            # squeue forgets finished jobs after a while; other errors are
+            # taken to be a busy controller
+            if (proc.returncode == 0 and not out.strip()) or b'Invalid job id' in err:
+                return
+            time.sleep(self.poll)
+
+class FakeScheduler(object):
+    '''
+        Runs the array tasks of a job script as local processes, at most
+        nworkers at a time, with the environment and output file Slurm
+        would give them
+    '''
+    def __init__(self, nworkers = 1):
+        self.nworkers = nworkers
+        self.jobs = {}
+        self.submitted = 0
+
+    def _run_task(self, script, jobid, index):
+        env = dict(os.environ, SLURM_JOB_ID = jobid, SLURM_ARRAY_JOB_ID = jobid, SLURM_ARRAY_TASK_ID = str(index))
+        logs = os.path.join(os.path.dirname(script), 'logs')
+        with open(os.path.join(logs, '{0}_{1}.out'.format(jobid, index)), 'w') as out:
+            subprocess.call(['sh', script], env = env, stdout = out, stderr = subprocess.STDOUT)
+
+    def submit(self, script, ntasks):
+        self.submitted += 1
+        jobid = 'fake{0}.{1}'.format(os.getpid(), self.submitted)
+        pool = ThreadPool(max(1, min(self.nworkers, ntasks)))
+        self.jobs[jobid] = (pool, pool.map_async(lambda index: self._run_task(script, jobid, index), range(ntasks), chunksize = 1))
+        return jobid
+
+    def wait(self, jobid):
+        pool, result = self.jobs.pop(jobid)
+        result.wait()
+        pool.close()
+        pool.join()
+
+class BatchExecutor(object):
+    def __init__(self, folder, scheduler = None, cores = None, memory = None, walltime = None, partition = None,
+                 max_parallel = None, options = (), log = None):
+        '''
+            folder is where the job folders are made. cores (per task),
+            memory (GB per task), walltime ('HH:MM:SS'), partition and
+            max_parallel (tasks of the array running at the same time) are
+            left to the scheduler if None. options are extra #SBATCH lines.
+        '''
+        self.folder = os.path.abspath(folder)
+        self.scheduler = scheduler if scheduler is not None else Slurm()
+        self.cores = cores
+        self.memory = memory
+        self.walltime = walltime
+        self.partition = partition
+        self.max_parallel = max_parallel
+        self.options = list(options)
+        self.log = log
+
+    def _function(self, func):
+        # Functions of a script that was started directly live in __main__
+        module = func.__module__
+        path = os.path.abspath(sys.modules[module].__file__)
+        if module == '__main__':
+            module = os.path.splitext(os.path.basename(path))[0]
+        return {'module': module, 'path': os.path.dirname(path), 'name': func.__name__}
+
+    def _script(self, job, ntasks):
+        name = os.path.basename(job)
+        lines = ['#!/bin/bash',
+                 '#SBATCH --job-name=dp5-{}'.format(name),
+                 '#SBATCH --array=0-{0}{1}'.format(ntasks - 1, '%{}'.format(self.max_parallel) if self.max_parallel else ''),
+                 '#SBATCH --output={}/logs/%A_%a.out'.format(job)]
+        if self.cores:
+            lines.append('#SBATCH --cpus-per-task={}'.format(self.cores))
+        if self.memory:
+            lines.append('#SBATCH --mem={}G'.format(int(self.memory + 0.999)))
+        if self.walltime:
+            lines.append('#SBATCH --time={}'.format(self.walltime))
+        if self.partition:
+            lines.append('#SBATCH --partition={}'.format(self.partition))
+        lines += ['#SBATCH {}'.format(option) for option in self.options]
+        lines.append('cd {}'.format(os.getcwd()))
+        # The budget of resources.py, which DP5.py splits over its workers.
+        # Without cores it is whatever the scheduler binds the task to, not
+        # the budget of the machine that submitted the job.
+        if self.cores:
+            lines.append('export DP5_CORES={}'.format(self.cores))
+        else:
+            lines.append('unset DP5_CORES DP5_THREADS')
+        lines.append('exec {0} {1} -job {2} -task $SLURM_ARRAY_TASK_ID'.format(sys.executable, os.path.abspath(__file__).replace('.pyc', '.py'), job))
+        script = os.path.join(job, 'job.sh')
+        with open(script, 'w') as handle:
+            handle.write('\n'.join(lines) + '\n')
+        return script
+
+    def map(self, func, tasks):
+        tasks = list(tasks)
+        if not tasks:
+            return []
+        if not os.path.isdir(self.folder):
+            os.makedirs(self.folder)
+        job = tempfile.mkdtemp(prefix = '{0}-{1}-'.format(func.__name__, time.strftime('%Y%m%d-%H%M%S')), dir = self.folder)
+        for sub in ('tasks', 'results', 'logs'):
+            os.makedirs(os.path.join(job, sub))
+        with open(os.path.join(job, 'job.pkl'), 'wb') as handle:
+            pickle.dump(self._function(func), handle, 2)
+        for index, arg in enumerate(tasks):
+            with open(os.path.join(job, 'tasks', '{}.pkl'.format(index)), 'wb') as handle:
+                pickle.dump(arg, handle, 2)
+        script = self._script(job, len(tasks))
+        jobid = self.scheduler.submit(script, len(tasks))
+        print('==== Submitted {0} task(s) as job {1}, see {2}/logs'.format(len(tasks), jobid, job))
+        self.scheduler.wait(jobid)
+        records = []
+        for index in range(len(tasks)):
+            try:
+                with open(os.path.join(job, 'results', '{}.pkl'.format(index)), 'rb') as handle:
+                    records.append(pickle.load(handle))
+            except (IOError, EOFError):
+                # Never ran, or was killed by the scheduler (time or memory limit)
+                records.append(_task_record(index, 0., 0., 'No result, see {0}/logs/{1}_{2}.out'.format(job, jobid, index)))
+        return _finish(records, 'batch {}'.format(jobid), self.log)
+
+def run_task(job, index):
+    '''
+        Runs task index of the job folder job, inside an array task
+    '''
+    with open(os.path.join(job, 'job.pkl'), 'rb') as handle:
+        function = pickle.load(handle)
+    with open(os.path.join(job, 'tasks', '{}.pkl'.format(index)), 'rb') as handle:
+        arg = pickle.load(handle)
+    sys.path.insert(0, function['path'])
+    func = getattr(importlib.import_module(function['module']), function['name'])
+    record = _call(func, arg, index)
+    if record['error'] is not None:
+        print(record['error'])
+    # Written under another name first, so the executor never reads half a result
+    result = os.path.join(job, 'results', '{}.pkl'.format(index))
+    with open(result + '.part', 'wb') as handle:
+        pickle.dump(record, handle, 2)
+    os.rename(result + '.part', result)
+    return 1 if record['error'] is not None else 0
+
+def add_arguments(parser):
+    '''
+        The executor options of map_runs.py and concatenation_pipeline.py
+    '''
+    parser.add_argument('-executor', choices = ['local', 'slurm', 'fake'], default = 'local',
+                        help = 'Run the tasks on this machine (local), as a Slurm job array (slurm), or as a job array on a local stand-in for Slurm (fake)')
+    parser.add_argument('-jobs_dir', type = str, help = 'Folder for the job scripts, arguments and results of the job arrays. Defaults to <p>jobs/', default = None)
+    parser.add_argument('-task_cores', type = int, help = 'Cores every array task asks for. Defaults to what the scheduler gives', default = None)
+    parser.add_argument('-walltime', type = str, help = 'Time limit of every array task (HH:MM:SS)', default = None)
+    parser.add_argument('-partition', type = str, help = 'Partition (queue) to submit the job arrays to', default = None)
+    parser.add_argument('-max_parallel', type = int, help = 'Most array tasks running at the same time', default = None)
+
+def make_executor(parsed, root, nworkers, log = None):
+    '''
+        The executor chosen by the options of add_arguments. root is the
+        run folder, nworkers the number of tasks that run at the same time
+        on this machine (local, fake).
+    '''
+    if parsed.executor == 'local':
+        return LocalExecutor(nworkers, log)
+    cores = parsed.task_cores
+    if parsed.executor == 'fake':
+        scheduler = FakeScheduler(nworkers)
+        # The fake tasks share this machine like local ones
+        cores = cores or int(os.environ.get('DP5_CORES', 0)) or None
+    else:
+        scheduler = Slurm()
+    return BatchExecutor(parsed.jobs_dir or os.path.join(root, 'jobs'), scheduler, cores, parsed.task_mem,
+                         parsed.walltime, parsed.partition, parsed.max_parallel, log = log)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Runs a single task of a job array')
+    parser.add_argument('-job', type = str, help = 'Job folder', required = True)
+    parser.add_argument('-task', type = int, help = 'Index of the task', required = True)
+    parsed = parser.parse_args()
+    sys.exit(run_task(parsed.job, parsed.task))
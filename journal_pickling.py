@@ -1,40 +1,184 @@
-import numpy as np
 import datetime
+import fcntl
+import json
 import pickle
+import time
 import os
-import sys
+
+'''
+    The run journal. Every call and attribute is a single JSON line that is
+    appended under an exclusive lock, so all pool workers can share one file
+    and a write costs the same at the end of a run as at the start. Files
+    written by the old pickling Locker are converted on first use.
+
+    Records are only read when they are asked for (return_last, [] or
+    query), which also picks up what other processes appended meanwhile.
+'''
+
+def _jsonable(value):
+    # numpy scalars and arrays, datetimes
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
 
 class Locker(object):
     def __init__(self, fname):
         self.fname = fname
+        self.reduction_calls = []
+        self.ncalls = 0
+        self.attrs = {}
+        self.records = []
+        self._by_step = {}
+        self._by_ms = {}
+        self._offset = 0
         if os.path.isfile(fname):
-            self._load()
-        else:
-            self.reduction_calls = []
-            self.ncalls = 0
-            self.attrs = {}
-        
-    def add_calls(self, call):
-        self.reduction_calls.append((datetime.datetime.today(), call))
-        self.ncalls += 1
-    
+            with open(fname, 'rb') as fl:
+                legacy = fl.read(1) == b'\x80'
+            if legacy:
+                self._convert()
+
+    def add_calls(self, call, step = None, ms = None, **extra):
+        '''
+            Journals a call. extra fields (timings, exit codes, ...) are
+            stored with it.
+        '''
+        self.add_record('call', call = call, step = step, ms = ms, **extra)
+
+    def add_record(self, kind, **fields):
+        record = {'type': kind, 'time': time.time(), 'pid': os.getpid()}
+        record.update(fields)
+        line = (json.dumps(record, default = _jsonable) + '\n').encode('utf-8')
+        with open(self.fname, 'ab') as fl:
+            fcntl.flock(fl, fcntl.LOCK_EX)
+            try:
+                fl.seek(0, 2)
+                before = fl.tell()
+                fl.write(line)
+                fl.flush()
+                after = fl.tell()
+            finally:
+                fcntl.flock(fl, fcntl.LOCK_UN)
+        if before == self._offset:
+            # Nobody else wrote since we last read, no need to read it back
+            self._offset = after
+            self._ingest(record)
+        return record
+
     def return_last(self):
+        self.refresh()
         return self.reduction_calls[-1][1]
-    
+
     def save(self):
-        with open(self.fname, 'wb') as fl:
-            pickle.dump(self.__dict__, fl, 2)
-    
-    def _load(self):
+        '''
+            Records are written as they are added; kept so existing callers work
+        '''
+        pass
+
+    def refresh(self):
+        '''
+            Reads the records other processes appended since the last read
+        '''
+        if not os.path.isfile(self.fname):
+            return
+        with open(self.fname, 'rb') as fl:
+            fcntl.flock(fl, fcntl.LOCK_SH)
+            try:
+                fl.seek(self._offset)
+                data = fl.read()
+            finally:
+                fcntl.flock(fl, fcntl.LOCK_UN)
+        # A line without newline is still being written
+        complete = data[:data.rfind(b'\n')+1]
+        self._offset += len(complete)
+        for line in complete.splitlines():
+            try:
+                self._ingest(json.loads(line.decode('utf-8')))
+            except ValueError:
+                continue
+
+    def query(self, step = None, ms = None, start = None, end = None, kind = 'call'):
+        '''
+            Records of a kind, optionally for one step and/or ms, and between
+            start and end (datetimes or unix times)
+        '''
+        self.refresh()
+        if step is not None:
+            candidates = self._by_step.get(step, [])
+        elif ms is not None:
+            candidates = self._by_ms.get(ms, [])
+        else:
+            candidates = range(len(self.records))
+        start = self._timestamp(start)
+        end = self._timestamp(end)
+        result = []
+        for idx in candidates:
+            record = self.records[idx]
+            if kind is not None and record.get('type') != kind:
+                continue
+            if ms is not None and record.get('ms') != ms:
+                continue
+            if start is not None and record['time'] < start:
+                continue
+            if end is not None and record['time'] > end:
+                continue
+            result.append(record)
+        return result
+
+    def _timestamp(self, when):
+        if isinstance(when, datetime.datetime):
+            return time.mktime(when.timetuple()) + when.microsecond*1e-6
+        return when
+
+    def _ingest(self, record):
+        idx = len(self.records)
+        self.records.append(record)
+        if record.get('step') is not None:
+            self._by_step.setdefault(record['step'], []).append(idx)
+        if record.get('ms') is not None:
+            self._by_ms.setdefault(record['ms'], []).append(idx)
+        if record.get('type') == 'call':
+            self.reduction_calls.append((datetime.datetime.fromtimestamp(record['time']), record['call']))
+            self.ncalls += 1
+        elif record.get('type') == 'attr':
+            self.attrs[record['name']] = record['value']
+
+    def _convert(self):
+        '''
+            Rewrites a pickled journal of the old Locker as JSON lines
+        '''
         with open(self.fname, 'rb') as fl:
             tempdict = pickle.load(fl)
-            self.__dict__.update(tempdict)
-    
+        lines = []
+        for date, call in tempdict.get('reduction_calls', []):
+            lines.append({'type': 'call', 'time': time.mktime(date.timetuple()), 'call': call, 'step': None, 'ms': None})
+        attrs = dict(tempdict.get('attrs', {}))
+        # The old Locker also pickled attributes set directly on it
+        for name, value in tempdict.items():
+            if name not in ('fname', 'reduction_calls', 'ncalls', 'attrs'):
+                attrs[name] = value
+        for name, value in attrs.items():
+            lines.append({'type': 'attr', 'time': time.time(), 'name': name, 'value': value})
+        tmpname = '{}.converting'.format(self.fname)
+        with open(tmpname, 'w') as fl:
+            for record in lines:
+                fl.write(json.dumps(record, default = _jsonable) + '\n')
+        os.rename(tmpname, self.fname)
+
+    def __getstate__(self):
+        '''
+            Pool workers mostly append, so the records are not sent along
+        '''
+        return {'fname': self.fname}
+
+    def __setstate__(self, state):
+        self.__init__(state['fname'])
+
     def __getitem__(self, name):
+        self.refresh()
         if type(name) == type(5):
             return self.reduction_calls[name]
         else:
             return self.attrs[name]
-    
+
     def __setitem__(self, name, data):
-        self.attrs[name] = data
+        self.add_record('attr', name = name, value = data)
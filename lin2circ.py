@@ -54,75 +54,284 @@ YY =   RR -  RL -  LR +  LL
 """
 
 import optparse
+import multiprocessing as mp
 import pyrap.tables as pt
 import numpy
 
+# Number of rows converted per block. Peak memory is roughly two blocks
+# (input and output buffer), independent of the size of the MS.
+DEFAULT_CHUNKSIZE = 20000
+
+# Same settings DPPP uses for msout.storagemanager=dysco
+DYSCO_SPEC = {'dataBitCount': 10, 'weightBitCount': 12, 'distribution': 'TruncatedGaussian',
+              'distributionTruncation': 2.5, 'normalization': 'AF', 'studentTNu': 0.0}
+
+def _add_column(t, column, newcol, inms, dysco=False):
+	print 'Adding the output column',newcol,'to',inms
+	shape = numpy.array(t.getcell(column,0)).shape
+	if dysco:
+		# The data manager keeps its name when its column is renamed by a swap
+		names = [dm['NAME'] for dm in t.getdminfo().values()]
+		name = newcol+'_dm'
+		while name in names:
+			name += '_'
+		coldmi = {'TYPE': 'DyscoStMan', 'NAME': name, 'SPEC': DYSCO_SPEC}
+		t.addcols(pt.maketabdesc(pt.makearrcoldesc(newcol, 0., valuetype='complex', shape=shape, options=5)), coldmi)
+	elif _is_dysco(t, column):
+		# A plain column for dysco input, in the default storage manager
+		t.addcols(pt.maketabdesc(pt.makearrcoldesc(newcol, 0., valuetype='complex', shape=shape)))
+	else:
+		coldmi = t.getdminfo(column)
+		coldmi['NAME'] = newcol
+		t.addcols(pt.maketabdesc(pt.makearrcoldesc(newcol, 0., valuetype='complex', shape=shape)), coldmi)
+
+def _is_dysco(t, column):
+	return t.getdminfo(column)['TYPE'] == 'DyscoStMan'
+
+# Mixing matrices acting on the correlation vector [XX,XY,YX,YY] (or
+# [RR,RL,LR,LL]); each row is one of the expressions in the docstring above.
+LIN2CIRC = 0.5*numpy.array([[1., -1j,  1j,  1.],
+                            [1.,  1j,  1j, -1.],
+                            [1., -1j, -1j, -1.],
+                            [1.,  1j, -1j,  1.]])
+
+CIRC2LIN = 0.5*numpy.array([[ 1.,   1.,  1.,   1.],
+                            [ 1j,  -1j,  1j,  -1j],
+                            [-1j,  -1j,  1j,   1j],
+                            [ 1.,  -1.,  -1.,  1.]])
+
+# CORR_TYPE written to the POLARIZATION table for the known bases
+CORR_TYPES = {'circular': [5,6,7,8], 'linear': [9,10,11,12]}
+
+def basis_matrix(basis):
+	'''
+		Returns the 4x4 mixing matrix for 'lin2circ', 'circ2lin', the name
+		of a text file holding a user defined matrix, or the matrix itself
+	'''
+	if isinstance(basis, numpy.ndarray):
+		matrix = basis
+	elif basis == 'lin2circ':
+		matrix = LIN2CIRC
+	elif basis == 'circ2lin':
+		matrix = CIRC2LIN
+	else:
+		matrix = numpy.loadtxt(basis, dtype=complex)
+	if matrix.shape != (4,4):
+		raise ValueError('A mixing matrix needs to be 4x4, got {}'.format(matrix.shape))
+	return matrix
+
+def convert(data, matrix, out=None, blocksize=65536):
+	'''
+		Applies matrix to the last (correlation) axis of data as a single
+		batched matrix product. If out is data itself the conversion is done
+		in place, going through a small scratch buffer of blocksize rows.
+	'''
+	mt = numpy.ascontiguousarray(matrix.T, dtype=data.dtype)
+	if out is None:
+		out = numpy.empty_like(data)
+	if not (data.flags.c_contiguous and out.flags.c_contiguous):
+		raise ValueError('convert needs C-contiguous input and output arrays')
+	flat = data.reshape(-1, 4)
+	oflat = out.reshape(-1, 4)
+	if numpy.may_share_memory(data, out):
+		scratch = numpy.empty((min(blocksize, len(flat)), 4), dtype=data.dtype)
+		for start in range(0, len(flat), blocksize):
+			n = min(blocksize, len(flat) - start)
+			numpy.dot(flat[start:start+n], mt, out=scratch[:n])
+			oflat[start:start+n] = scratch[:n]
+	else:
+		numpy.dot(flat, mt, out=oflat)
+	return out
+
+def convert_rows(t, column, outcol, matrix, chunksize=DEFAULT_CHUNKSIZE, startrow=0, nrow=None, lock=False):
+	'''
+		Streams column through convert in blocks of chunksize rows and
+		writes the result to outcol. Both buffers are allocated once and
+		reused for every block, so memory stays bounded for any MS size.
+		With lock, t has to be opened with lockoptions='user' and the
+		table is only locked while a block is read or written, so several
+		processes can work on different row ranges of the same table.
+		A matrix of None copies column to outcol as it is.
+	'''
+	if nrow is None:
+		nrow = t.nrows() - startrow
+	if lock:
+		t.lock(write=False)
+	cell = numpy.asarray(t.getcell(column, startrow))
+	if lock:
+		t.unlock()
+	nbuf = max(1, min(chunksize, nrow))
+	inbuf = numpy.empty((nbuf,) + cell.shape, dtype=cell.dtype)
+	outbuf = numpy.empty_like(inbuf)
+	for start in range(startrow, startrow + nrow, nbuf):
+		n = min(nbuf, startrow + nrow - start)
+		if lock:
+			t.lock(write=False)
+		t.getcolnp(column, inbuf[:n], start, n)
+		if lock:
+			t.unlock()
+		if matrix is not None:
+			convert(inbuf[:n], matrix, outbuf[:n])
+		if lock:
+			t.lock(write=True)
+		t.putcol(outcol, outbuf[:n] if matrix is not None else inbuf[:n], start, n)
+		if lock:
+			t.unlock()
+
+def _convert_range(args):
+	'''
+		Worker for convert_ms: converts one row range with its own table handle
+	'''
+	inms, column, outcol, matrix, chunksize, startrow, nrow = args
+	t = pt.table(inms, readonly=False, ack=False, lockoptions='user')
+	convert_rows(t, column, outcol, matrix, chunksize, startrow, nrow, lock=True)
+	t.close()
+	return nrow
+
+def row_ranges(nrows, jobs):
+	'''
+		Splits nrows into at most jobs contiguous (startrow, nrow) ranges
+	'''
+	jobs = max(1, min(jobs, nrows))
+	bounds = numpy.linspace(0, nrows, jobs+1).astype(int)
+	return [(int(lo), int(hi-lo)) for lo,hi in zip(bounds[:-1], bounds[1:])]
+
+def get_corr_type(inms):
+	'''
+		The CORR_TYPE of the (first) polarisation setup of inms
+	'''
+	tp = pt.table(inms+'/POLARIZATION', ack=False)
+	corr_type = [int(x) for x in tp.getcell('CORR_TYPE', 0)]
+	tp.close()
+	return corr_type
+
+def convert_ms(inms, basis='lin2circ', column='DATA', outcol='DATA_CIRC', chunksize=DEFAULT_CHUNKSIZE, corr_type=None, jobs=1, dysco=False):
+	'''
+		Converts column of inms to another polarisation basis and stores it
+		in outcol, which is created if needed. basis is anything basis_matrix
+		accepts. If corr_type is given, the POLARIZATION table is updated,
+		and a ms that already has that CORR_TYPE is refused.
+		With jobs > 1 the rows are split over that many worker processes.
+		If outcol is column the data is converted in place: it is written to
+		a temporary column that replaces column at the end, so an
+		interrupted conversion leaves column untouched and can be rerun.
+		dysco stores the output dysco compressed. Dysco columns can only
+		be written by a single process, so with jobs > 1 the workers write
+		a plain column first, which one final pass compresses into outcol.
+		That needs room for an uncompressed copy of the column meanwhile.
+	'''
+	matrix = basis_matrix(basis)
+	if corr_type is not None and get_corr_type(inms) == list(corr_type):
+		raise ValueError('{0} already has CORR_TYPE {1}, not converting it again'.format(inms, list(corr_type)))
+	t = pt.table(inms, readonly=False, ack=True)
+	swap = outcol == column
+	if swap:
+		outcol = column + '_CONV'
+		if column not in t.colnames() and outcol in t.colnames():
+			# Interrupted between removing column and renaming outcol
+			print 'Finishing the interrupted swap of', outcol, 'into', column
+			t.renamecol(outcol, column)
+			t.close()
+			_put_corr_type(inms, corr_type)
+			return
+	if column not in t.colnames():
+		t.close()
+		raise ValueError('Input column {} does not exist'.format(column))
+	if swap and corr_type is not None and _converted_to(t, column) == list(corr_type):
+		# Interrupted between the swap and the update of the POLARIZATION table
+		print column, 'was already converted, only updating the POLARIZATION table'
+		t.close()
+		_put_corr_type(inms, corr_type)
+		return
+	if swap:
+		# Left over from an interrupted conversion, column itself is still intact
+		if outcol in t.colnames():
+			t.removecols([outcol])
+		# An in place conversion keeps a dysco column dysco
+		dysco = dysco or _is_dysco(t, column)
+	if jobs > 1 and mp.current_process().daemon:
+		print 'Cannot start worker processes from a daemonic process, converting with one job'
+		jobs = 1
+	target = outcol
+	if jobs > 1 and (_is_dysco(t, outcol) if outcol in t.colnames() else dysco):
+		# Dysco compresses whole timesteps and expects its rows written in
+		# order by a single storage manager, not ranges from several handles.
+		# Its column is only added after the workers are done, since other
+		# handles cannot open the table while it is still empty.
+		target = outcol + '_PAR'
+		if target in t.colnames():
+			t.removecols([target])
+	if target not in t.colnames():
+		_add_column(t, column, target, inms, dysco and target == outcol)
+	if jobs > 1:
+		ranges = row_ranges(t.nrows(), jobs)
+		t.close()
+		print 'Converting', column, 'to', target, 'with', len(ranges), 'jobs in blocks of', chunksize, 'rows...'
+		pool = mp.Pool(len(ranges))
+		pool.map(_convert_range, [(inms, column, target, matrix, chunksize, start, nrow) for start,nrow in ranges])
+		pool.close()
+		pool.join()
+		if target != outcol:
+			print 'Compressing', target, 'into', outcol, 'in blocks of', chunksize, 'rows...'
+			t = pt.table(inms, readonly=False, ack=False)
+			if outcol not in t.colnames():
+				_add_column(t, column, outcol, inms, True)
+			convert_rows(t, target, outcol, None, chunksize)
+			t.removecols([target])
+			t.close()
+	else:
+		print 'Converting', column, 'to', outcol, 'in blocks of', chunksize, 'rows...'
+		convert_rows(t, column, outcol, matrix, chunksize)
+		t.close()
+	if swap:
+		print 'Replacing', column, 'by', outcol
+		t = pt.table(inms, readonly=False, ack=False)
+		if corr_type is not None:
+			# Travels with the column, so a rerun knows the data is converted
+			t.putcolkeyword(outcol, 'CONVERTED_TO', numpy.array(corr_type, dtype=numpy.int32))
+		t.removecols([column])
+		t.renamecol(outcol, column)
+		t.close()
+	_put_corr_type(inms, corr_type)
+
+def _converted_to(t, column):
+	keywords = t.getcolkeywords(column)
+	if 'CONVERTED_TO' not in keywords:
+		return None
+	return [int(x) for x in keywords['CONVERTED_TO']]
+
+def _put_corr_type(inms, corr_type):
+	if corr_type is not None:
+		print 'Updating the POLARIZATION table...'
+		tp = pt.table(inms+'/POLARIZATION',readonly=False,ack=True)
+		tp.putcol('CORR_TYPE',numpy.array([corr_type],dtype=numpy.int32))
+		tp.close()
+
 def main(options):
 
-	cI = numpy.complex(0.,1.)
-	
 	inms = options.inms
 	if inms == '':
 			print 'Error: you have to specify an input MS, use -h for help'
 			return
 	column = options.column
-	outcol = options.outcol
-	
-	t = pt.table(inms, readonly=False, ack=True)
-	if options.back:
-		lincol = options.lincol
-		if lincol not in t.colnames():
-				print 'Adding the output linear polarization column',lincol,'to',inms
-				coldmi = t.getdminfo(column)
-				coldmi['NAME'] = lincol
-				t.addcols(pt.maketabdesc(pt.makearrcoldesc(lincol, 0., valuetype='complex', shape=numpy.array(t.getcell(column,0)).shape)), coldmi)
-
-                ### RVW EDIT 2012   
-		print 'Reading the input column (circular)', column
-		if column not in t.colnames():
-			print 'Error: Input column does not exist'
-			return
-		
-		### RVW EDIT 2012 Input column with the -c switch 
-		cirdata = t.getcol(column)
-		#cirdata = t.getcol(outcol)
-		#print 'SHAPE ARRAY', numpy.shape(cirdata)
-		
-		print 'Computing the linear polarization terms...'
-		lindata = numpy.transpose(numpy.array([
-				0.5*(cirdata[:,:,0]+cirdata[:,:,1]+cirdata[:,:,2]+cirdata[:,:,3]),
-				0.5*(cI*cirdata[:,:,0]-cI*cirdata[:,:,1]+cI*cirdata[:,:,2]-cI*cirdata[:,:,3]),
-				0.5*(-cI*cirdata[:,:,0]-cI*cirdata[:,:,1]+cI*cirdata[:,:,2]+cI*cirdata[:,:,3]),
-				0.5*(cirdata[:,:,0]-cirdata[:,:,1]-cirdata[:,:,2]+cirdata[:,:,3])]),
-				(1,2,0))
-		print 'Finishing up...'
-		t.putcol(lincol, lindata)
+	if options.matrix:
+		basis, outcol, corr_type = options.matrix, options.outcol, None
+		if options.poltable:
+			print 'Not updating the POLARIZATION table: unknown CORR_TYPE for a user defined matrix'
+	elif options.back:
+		basis, outcol, corr_type = 'circ2lin', options.lincol, CORR_TYPES['linear'] # FROM CIRC-->LIN
 	else:
-		if outcol not in t.colnames():
-			print 'Adding the output column',outcol,'to',inms
-			coldmi = t.getdminfo(column)
-			coldmi['NAME'] = outcol
-			t.addcols(pt.maketabdesc(pt.makearrcoldesc(outcol, 0., valuetype='complex', shape=numpy.array(t.getcell(column,0)).shape)), coldmi)
-		print 'Reading the input column (linear)', column
-		data = t.getcol(column)
-		print 'Computing the output column'
-		outdata = numpy.transpose(numpy.array([
-				0.5*(data[:,:,0]-cI*data[:,:,1]+cI*data[:,:,2]+data[:,:,3]),
-				0.5*(data[:,:,0]+cI*data[:,:,1]+cI*data[:,:,2]-data[:,:,3]),
-				0.5*(data[:,:,0]-cI*data[:,:,1]-cI*data[:,:,2]-data[:,:,3]),
-				0.5*(data[:,:,0]+cI*data[:,:,1]-cI*data[:,:,2]+data[:,:,3])]),
-				(1,2,0))
-		print 'Finishing up...'
-		t.putcol(outcol, outdata)
-	if options.poltable:
-		print 'Updating the POLARIZATION table...'
-		tp = pt.table(inms+'/POLARIZATION',readonly=False,ack=True)
-		
-		### RVW EDIT 2012
-		if options.back:
-		   tp.putcol('CORR_TYPE',numpy.array([[9,10,11,12]],dtype=numpy.int32)) # FROM CIRC-->LIN
-                else:
-		   tp.putcol('CORR_TYPE',numpy.array([[5,6,7,8]],dtype=numpy.int32)) # FROM LIN-->CIRC
+		basis, outcol, corr_type = 'lin2circ', options.outcol, CORR_TYPES['circular'] # FROM LIN-->CIRC
+	if not options.poltable:
+		corr_type = None
+	if options.inplace:
+		outcol = column
+	try:
+		convert_ms(inms, basis, column, outcol, options.chunksize, corr_type, options.jobs, options.dysco)
+	except ValueError as e:
+		print 'Error:', e
+		return
+	print 'Finishing up...'
 
 if __name__ == '__main__':
     opt = optparse.OptionParser()
@@ -132,6 +341,11 @@ if __name__ == '__main__':
     opt.add_option('-p','--poltable',help='Update POLARIZATION table? [default False]',default=False,action='store_true')
     opt.add_option('-b','--back',help='Go back to linear polarization [default False]',default=False,action='store_true')
     opt.add_option('-l','--lincol',help='Output linear polarization column, if the -b switch is used [default DATA_LIN]; we want to keep the original DATA column',default='DATA_LIN')
+    opt.add_option('-x','--matrix',help='Text file with a user defined 4x4 mixing matrix, written to --outcol [default None]',default=None)
+    opt.add_option('-n','--chunksize',help='Number of rows converted per block [default {}]'.format(DEFAULT_CHUNKSIZE),default=DEFAULT_CHUNKSIZE,type='int')
+    opt.add_option('-I','--inplace',help='Overwrite the input column instead of writing to --outcol/--lincol [default False]',default=False,action='store_true')
+    opt.add_option('-z','--dysco',help='Store the output column dysco compressed [default False]',default=False,action='store_true')
+    opt.add_option('-j','--jobs',help='Number of processes converting row ranges in parallel [default 1]',default=1,type='int')
     options, arguments = opt.parse_args()
     print(options)
-    #main(options)
+    main(options)
@@ -2,14 +2,16 @@
 import DP5 as run
 import os
 import argparse
-import multiprocessing as mp
 import subprocess
+import resources as rs
+import executors as ex
+import journal_pickling as jp
 
 RUNSTRING = 'mu'
 
 def single_reduction(combi_tuple):
     ms, p, s, m, n = combi_tuple
-    fp = run.FakeParser(ms+n+'/', p+n+'/', s, False, True, m, False)
+    fp = run.FakeParser(ms+n+'/', p+n+'/', s, True, m, False)
     os.mkdir(p+n)
     run.main(fp, os.getcwd())
 
@@ -18,6 +20,9 @@ if __name__ == '__main__':
     parser.add_argument('-r', type = str, help = 'Location of the root directory containing the measurement sets')
     parser.add_argument('-p', type = str, help = 'Location of the root run directory')
     parser.add_argument('-m', type = str, help = 'Location of the model')
+    parser.add_argument('-cores', type = int, help = 'Number of cores to use. Defaults to all cores of the machine', default = None)
+    parser.add_argument('-task_mem', type = float, help = 'Memory (GB) a single reduction needs; limits the number of parallel reductions', default = None)
+    ex.add_arguments(parser)
 
     parsed = parser.parse_args()
     assert parsed.r[-1] == '/'
@@ -27,8 +32,14 @@ if __name__ == '__main__':
     for val in dirlist:
         number_dirs.append(val)
     
-    pl = mp.Pool(mp.cpu_count())
+    # Every reduction gets an equal share of the cores, which the nested
+    # DP5 runs pick up from the environment
+    resources = rs.ResourceManager(parsed.cores)
+    nworkers = resources.workers(len(number_dirs), parsed.task_mem*rs.GB if parsed.task_mem else None)
+    resources.export(nworkers)
+    # Every finished reduction is journalled in <p>log, wherever it ran
+    executor = ex.make_executor(parsed, parsed.p, nworkers, jp.Locker(parsed.p + 'log'))
     combi_tuples = []
     for n in number_dirs:
         combi_tuples.append((parsed.r, parsed.p, RUNSTRING, parsed.m, n))
-    pl.map(single_reduction, combi_tuples)
+    executor.map(single_reduction, combi_tuples)
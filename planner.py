@@ -0,0 +1,212 @@
+from __future__ import print_function
+import os
+import json
+import journal_pickling as jp
+
+'''
+    Dry runs of DP5.py (-plan). The task graph of a reduction is turned into
+    the calls every task would make, without touching any data, together
+    with an estimate of how much each call reads and writes and how long it
+    takes. The plan is saved as JSON and as a shell script that makes the
+    same calls in a valid serial order.
+
+    Runtimes come from the journals of earlier runs: the median seconds per
+    GB of measurement set of every kind of call (see signature). Calls that
+    no journal has seen get DEFAULT_RATES. The I/O is estimated from the
+    size of the ms on disk:
+        DPPP      reads the ms; writes COLUMN_FRACTION of it when it adds
+                  a data column, all of it when it writes a new ms
+        wsclean   reads the ms and writes it once more as reordered data,
+                  a predict writes a column instead
+'''
+
+GB = 1024.**3
+
+# Seconds per GB of ms for calls without timings in any journal
+DEFAULT_RATES = {'DPPP': 30., 'DP3': 30., 'wsclean': 120.}
+# Share of an ms a new (dysco compressed) data column takes
+COLUMN_FRACTION = 0.3
+
+_sizes = {}
+
+def ms_size(ms):
+    '''
+        Bytes on disk of ms, cached
+    '''
+    ms = ms.rstrip('/')
+    if ms not in _sizes:
+        total = 0
+        for root, dirs, files in os.walk(ms):
+            total += sum(os.path.getsize(os.path.join(root, name)) for name in files
+                         if not os.path.islink(os.path.join(root, name)))
+        _sizes[ms] = total
+    return _sizes[ms]
+
+def call_ms(call):
+    '''
+        The existing measurement sets a call reads
+    '''
+    mslist = []
+    for word in call.split()[1:]:
+        if word.startswith('msin='):
+            word = word[len('msin='):]
+        if os.path.isfile(os.path.join(word, 'table.dat')) and word not in mslist:
+            mslist.append(word)
+    return mslist
+
+def _options(call):
+    return dict(word.split('=', 1) for word in call.split()[1:] if '=' in word)
+
+def signature(call):
+    '''
+        The kind of a call, which is the same in every run: the tool and,
+        for DPPP, its steps and where it writes to
+    '''
+    words = call.split()
+    tool = os.path.basename(words[0])
+    if tool in ('DPPP', 'DP3'):
+        options = _options(call)
+        out = options.get('msout.datacolumn', '') if options.get('msout', '.') == '.' else 'ms'
+        return '{0} steps={1} out={2}'.format(tool, options.get('steps', ''), out)
+    elif tool == 'wsclean':
+        return 'wsclean -predict' if '-predict' in words else 'wsclean'
+    return tool
+
+def io_volume(call, size):
+    '''
+        Estimated bytes read and written by call on size bytes of ms
+    '''
+    words = call.split()
+    tool = os.path.basename(words[0])
+    if tool in ('DPPP', 'DP3'):
+        options = _options(call)
+        if options.get('msout', '.') != '.':
+            return size, size
+        if 'msout.datacolumn' in options:
+            return size, COLUMN_FRACTION*size
+        return size, 0
+    elif tool == 'wsclean':
+        if '-predict' in words:
+            return size, COLUMN_FRACTION*size
+        return size, size
+    return 0, 0
+
+def rates(journals):
+    '''
+        Median seconds per GB (or seconds, for calls that read no ms) of
+        every kind of call that succeeded in the journals
+    '''
+    samples = {}
+    for fname in journals:
+        if not os.path.isfile(fname):
+            continue
+        for record in jp.Locker(fname).query():
+            if not record.get('wall') or record.get('exitcode') or not record.get('call'):
+                continue
+            size = sum(ms_size(ms) for ms in call_ms(record['call']))
+            value = record['wall']/(size/GB) if size else record['wall']
+            samples.setdefault((signature(record['call']), bool(size)), []).append(value)
+    return {key: sorted(values)[len(values)//2] for key, values in samples.items()}
+
+def estimate(call, table):
+    '''
+        Plan entry of a single call. Comments (work done in python) cost nothing.
+    '''
+    entry = {'call': call, 'read_bytes': 0, 'write_bytes': 0, 'seconds': 0., 'source': None}
+    if call.startswith('#'):
+        return entry
+    size = sum(ms_size(ms) for ms in call_ms(call))
+    entry['read_bytes'], entry['write_bytes'] = io_volume(call, size)
+    kind = signature(call)
+    if size and (kind, True) in table:
+        entry['seconds'] = table[(kind, True)]*size/GB
+        entry['source'] = 'journal'
+    elif (kind, False) in table:
+        # Timed on ms that are gone, so without a size
+        entry['seconds'] = table[(kind, False)]
+        entry['source'] = 'journal'
+    else:
+        entry['seconds'] = DEFAULT_RATES.get(os.path.basename(call.split()[0]), 0.)*size/GB
+        entry['source'] = 'default'
+    return entry
+
+def task_commands(task):
+    '''
+        The calls a task of DP5.build_graph would make. The first argument
+        of every task is the object that runs it.
+    '''
+    cal = task.args[0]
+    stage = task.name.split(':')[1]
+    if stage == 'solve' and 'solve_apply' in task.args[1:]:
+        stage = 'solve_apply'
+    return cal.commands(stage, task.args[1] if stage == 'image' else None)
+
+def plan(graph, journals = (), nworkers = 1):
+    '''
+        Plans every task of graph. The runtime of the run is the longest
+        chain of dependent tasks, or the serial time spread over nworkers
+        workers if that is longer.
+    '''
+    table = rates(journals)
+    tasks = []
+    finish = {}
+    for task in graph:
+        calls = [estimate(call, table) for call in task_commands(task)]
+        seconds = sum(call['seconds'] for call in calls)
+        finish[task.name] = max([finish[dep] for dep in task.deps] or [0.]) + seconds
+        tasks.append({'name': task.name, 'step': task.step, 'ms': task.ms, 'deps': task.deps,
+                      'calls': calls, 'seconds': seconds, 'finish': finish[task.name],
+                      'read_bytes': sum(call['read_bytes'] for call in calls),
+                      'write_bytes': sum(call['write_bytes'] for call in calls)})
+    serial = sum(task['seconds'] for task in tasks)
+    critical = max(finish.values()) if finish else 0.
+    return {'tasks': tasks, 'workers': nworkers, 'journals': list(journals),
+            'read_bytes': sum(task['read_bytes'] for task in tasks),
+            'write_bytes': sum(task['write_bytes'] for task in tasks),
+            'serial_seconds': serial, 'critical_seconds': critical,
+            'seconds': max(critical, serial/max(1, nworkers))}
+
+def write_plan(result, prefix):
+    '''
+        Saves the plan as <prefix>.json and <prefix>.sh
+    '''
+    with open('{}.json'.format(prefix), 'w') as handle:
+        json.dump(result, handle, indent = 1)
+    with open('{}.sh'.format(prefix), 'w') as handle:
+        handle.write('#!/bin/sh\n')
+        handle.write('# The calls of a DP5.py run in a valid serial order. Lines starting with #\n')
+        handle.write('# are done in python by DP5.py and are not repeated by this script.\n')
+        handle.write('set -e\n')
+        for task in result['tasks']:
+            handle.write('\n# ---- {0} (after: {1})\n'.format(task['name'], ', '.join(task['deps']) or '-'))
+            for call in task['calls']:
+                handle.write(call['call'] + '\n')
+    os.chmod('{}.sh'.format(prefix), 0o755)
+
+def print_plan(result):
+    '''
+        Summary of a plan per step
+    '''
+    steps = []
+    totals = {}
+    for task in result['tasks']:
+        if task['step'] not in totals:
+            steps.append(task['step'])
+            totals[task['step']] = {'tasks': 0, 'read': 0., 'write': 0., 'hours': 0., 'default': False}
+        entry = totals[task['step']]
+        entry['tasks'] += 1
+        entry['read'] += task['read_bytes']
+        entry['write'] += task['write_bytes']
+        entry['hours'] += task['seconds']/3600.
+        entry['default'] |= any(call['source'] == 'default' for call in task['calls'])
+    print('{0:<8}{1:>7}{2:>11}{3:>12}{4:>11}'.format('step', 'tasks', 'read (GB)', 'write (GB)', 'tasks (h)'))
+    for step in steps:
+        entry = totals[step]
+        print('{0:<8}{1:>7}{2:>11.1f}{3:>12.1f}{4:>11.2f}{5}'.format(step, entry['tasks'], entry['read']/GB, entry['write']/GB,
+              entry['hours'], ' *' if entry['default'] else ''))
+    print('Total: {0:.1f} GB read, {1:.1f} GB written, {2:.2f} h of tasks'.format(result['read_bytes']/GB,
+          result['write_bytes']/GB, result['serial_seconds']/3600.))
+    print('Estimated wall time with {0} worker(s): {1:.2f} h (longest chain {2:.2f} h)'.format(result['workers'],
+          result['seconds']/3600., result['critical_seconds']/3600.))
+    if any(entry['default'] for entry in totals.values()):
+        print('* includes calls without timings in the journals, estimated with default rates')
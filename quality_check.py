@@ -10,17 +10,33 @@ import argparse
 import journal_pickling as jp
 import shutil
 from astropy.io import fits
+from multiprocessing.pool import ThreadPool
 
-def calcrms(arra):
-    xcenter = 40
-    ycenter = 40
-    rad = 30
-    grid = np.mgrid[:np.shape(arra)[0], :np.shape(arra)[1]]
-    xdists = grid[1] - xcenter
-    ydists = grid[0] - ycenter
-    dists2 = xdists**2 + ydists**2
-    mask = dists2 < rad**2
-    selected = arra[mask]
+# Centre (x, y) and radius in pixels of the disc the rms is measured in
+RMS_CENTRE = (40, 40)
+RMS_RADIUS = 30
+# Rows of an image plane that are scanned at a time
+BLOCK = 512
+
+_discs = {}
+
+def disc(shape, centre = RMS_CENTRE, radius = RMS_RADIUS):
+    '''
+        Bounding box (as slices) and mask inside it of the disc, cached
+        per image shape
+    '''
+    key = (shape, tuple(centre), radius)
+    if key not in _discs:
+        xcenter, ycenter = centre
+        y0, y1 = max(0, ycenter - radius), min(shape[0], ycenter + radius + 1)
+        x0, x1 = max(0, xcenter - radius), min(shape[1], xcenter + radius + 1)
+        ydists, xdists = np.ogrid[y0-ycenter:y1-ycenter, x0-xcenter:x1-xcenter]
+        _discs[key] = ((slice(y0, y1), slice(x0, x1)), xdists**2 + ydists**2 < radius**2)
+    return _discs[key]
+
+def calcrms(arra, centre = RMS_CENTRE, radius = RMS_RADIUS):
+    box, mask = disc(np.shape(arra), centre, radius)
+    selected = np.asarray(arra[box], dtype = float)[mask]
     return np.sqrt(np.mean(selected**2))
 
 def max_min(arra):
@@ -29,6 +45,45 @@ def max_min(arra):
 def snr(arra):
     return np.max(arra)/calcrms(arra)
 
+def image_metrics(fname, centre = RMS_CENTRE, radius = RMS_RADIUS):
+    '''
+        rms, max/|min| and max/rms of the first plane of a FITS image. The
+        image is memory mapped and the plane is scanned once, in blocks of
+        rows, for both the maximum and the minimum.
+    '''
+    with fits.open(fname, memmap = True) as hdul:
+        data = hdul[0].data
+        plane = data.reshape((-1,) + data.shape[-2:])[0]
+        rms = calcrms(plane, centre, radius)
+        vmax = -np.inf
+        vmin = np.inf
+        for start in range(0, plane.shape[0], BLOCK):
+            block = np.asarray(plane[start:start+BLOCK])
+            vmax = max(vmax, float(block.max()))
+            vmin = min(vmin, float(block.min()))
+    return rms, vmax/np.abs(vmin), vmax/rms
+
+def run_metrics(fpath, dirlist, centre = RMS_CENTRE, radius = RMS_RADIUS, threads = None):
+    '''
+        image_metrics of the image of every run in dirlist, in parallel
+    '''
+    fnames = []
+    for run in dirlist:
+        fname = fpath+run+'/ws-image.fits'
+        if not os.path.isfile(fname):
+            fname = fpath+run+'/ws-MFS-image.fits'
+        fnames.append(fname)
+    if not fnames:
+        return []
+    if threads is None:
+        threads = int(os.environ.get('DP5_CORES', 1))
+    pool = ThreadPool(max(1, min(threads, len(fnames))))
+    try:
+        return pool.map(lambda fname: image_metrics(fname, centre, radius), fnames)
+    finally:
+        pool.close()
+        pool.join()
+
 def copy_images(pth,redsteps):
     '''
         Standalone version. Will need the reduction string, but figures
@@ -91,33 +146,31 @@ def plotter(text, x, y, path):
     fig.savefig(path, format = 'pdf', bbox_inches = 'tight')
 
 
-def main(fpath, redsteps, nlist):
+def main(fpath, redsteps, nlist, centre = RMS_CENTRE, radius = RMS_RADIUS):
     logger = jp.Locker(fpath+'log')
     logger.add_calls('quality_check')
 
     dirlist = rebuild_dirlist(redsteps, nlist)
-    rms = []
-    maxmin = []
-    snrs = []
-    for run in dirlist:
-        try:
-            data = fits.getdata(fpath+run+'/ws-image.fits')[0,0,:,:]
-        except:
-            data = fits.getdata(fpath+run+'/ws-MFS-image.fits')[0,0,:,:]
-        rms.append(calcrms(data))
-        maxmin.append(max_min(data))
-        snrs.append(snr(data))
+    metrics = run_metrics(fpath, dirlist, centre, radius)
+    rms = [m[0] for m in metrics]
+    maxmin = [m[1] for m in metrics]
+    snrs = [m[2] for m in metrics]
     copy_images(fpath,redsteps)
     
-    logger.rms = rms
-    logger.maxmin = maxmin
-    logger.snrs = snrs
+    logger['rms'] = rms
+    logger['maxmin'] = maxmin
+    logger['snrs'] = snrs
 
     plotter('RMS', dirlist, rms, fpath+'rms.pdf')
     plotter('I_max/I_min', dirlist, maxmin, fpath+'maxmin.pdf')
     plotter('Signal to noise (max/rms)', dirlist, snrs, fpath+'snr.pdf')
 
-    logger.save()
-
 if __name__ == "__main__":
-    main(sys.argv[1], sys.argv[2], sys.argv[3])
+    parser = argparse.ArgumentParser(description = 'Image quality metrics of a run')
+    parser.add_argument('fpath', type = str, help = 'Run folder')
+    parser.add_argument('redsteps', type = str, help = 'Reduction string of the run')
+    parser.add_argument('nlist', type = str, help = 'Step numbers, one digit per step')
+    parser.add_argument('-centre', type = int, nargs = 2, help = 'Centre (x y) in pixels of the disc the rms is measured in', default = RMS_CENTRE)
+    parser.add_argument('-radius', type = int, help = 'Radius in pixels of that disc', default = RMS_RADIUS)
+    parsed = parser.parse_args()
+    main(parsed.fpath, parsed.redsteps, parsed.nlist, tuple(parsed.centre), parsed.radius)
@@ -2,27 +2,61 @@ from __future__ import print_function
 import numpy as np
 import sys
 import os
-import subprocess
 import journal_pickling as jp
+from runner import run_command
+from cache import cached_call, cached_fused_call
+from reorder import ReorderCache
 from .tools import parse_pset
+from .tools import fuse_psets
 from astropy.io import fits
+from multiprocessing.pool import ThreadPool
 from .tools import process_diag
+from .tools import makedir
+from .plotting import plot_h5parm, read_plot_pset
 
-def suppressNegatives(pth):
+def _clip(fname):
     '''
-        Sets all negative values in a particular model image to 0
+        Sets the negative values of a model image to 0 in place and
+        returns its total flux
+    '''
+    with fits.open(fname, mode = 'update', memmap = True) as hdul:
+        data = hdul[0].data
+        np.maximum(data, 0, out = data)
+        return float(np.nansum(data))
+
+def _scale(args):
+    fname, factor = args
+    with fits.open(fname, mode = 'update', memmap = True) as hdul:
+        hdul[0].data *= factor
+
+def suppressNegatives(pth, reference = None, threads = None):
+    '''
+        Sets all negative values in the model images in pth to 0
         c.f. RvW
+        With a reference model image, the models are then scaled so that
+        their mean flux per channel matches the total flux of the
+        reference. The images are memory mapped and changed in place, by
+        threads threads (DP5_THREADS by default).
     '''
     models = list(filter(lambda x: 'model' in x and 'MFS' not in x, os.listdir(pth)))
     model_paths = ['{0}/{1}'.format(pth,model) for model in models]
-    for mp in model_paths:
-        hdul = fits.open(mp)
-        data = hdul[0].data
-        negmask = data<0
-        data[negmask] = 0
-        hdul[0].data = data
-        hdul.writeto(mp, overwrite=True)
-        hdul.close()
+    if not model_paths:
+        return
+    if threads is None:
+        threads = int(os.environ.get('DP5_THREADS', 1))
+    pool = ThreadPool(max(1, min(threads, len(model_paths))))
+    try:
+        fluxes = pool.map(_clip, model_paths)
+        if reference is not None:
+            ref_flux = float(np.nansum(fits.getdata(reference)))
+            model_flux = sum(fluxes)/len(fluxes)
+            if model_flux > 0:
+                factor = ref_flux/model_flux
+                print('==== Scaling the models in {0} by {1:.4g} to the flux of {2}'.format(pth, factor, reference))
+                pool.map(_scale, [(mp, factor) for mp in model_paths])
+    finally:
+        pool.close()
+        pool.join()
 
 class DiagonalCalibrator(object):
     def __init__(self, n, ms, fpath, pset_loc = './'):
@@ -32,7 +66,7 @@ class DiagonalCalibrator(object):
         self.initialized = False
         self.pset_loc = pset_loc
         self.log = jp.Locker(fpath+'log')
-        self.DEBUG = False
+        self.step = 'd{}'.format(n)
         assert fpath[-1] == '/'
         assert ms[-1] == '/'
         assert pset_loc[-1] == '/'
@@ -50,41 +84,6 @@ class DiagonalCalibrator(object):
         except OSError:
             pass
 
-    def _init_losoto(self):
-        '''
-            This needs to be ran right before calling it.
-            It changes the losoto parset and can conflict if not ran
-            immediately afterwards.
-        '''
-        np.random.seed(np.abs(hash(self.ms))%2**31)
-        self.prephasename = '{:05d}'.format(np.random.randint(20000))
-        self.ampname = '{:05d}'.format(np.random.randint(20000))
-        self.slowphasename = '{:05d}'.format(np.random.randint(20000))
-        with open(self.pset_loc + 'lstp.pset', 'r') as handle:
-            data = [line for line in handle]
-        os.mkdir('{0}/losoto/apcal{1}/'.format( self.ms, self.n))
-        data[-1] = 'prefix = {0}/losoto/apcal{1}/prephase'.format(self.ms, self.n)
-        self.losoto_p = 'losoto {0}instrument_p{1}.h5 {2}'.format(self.ms, self.n, self.prephasename)
-        with open(self.prephasename, 'w') as handle:
-            for line in data:
-                handle.write(line)
-
-        with open(self.pset_loc + 'lsta.pset', 'r') as handle:
-            data = [line for line in handle]
-        data[-1] = 'prefix = {0}/losoto/apcal{1}/amp'.format(self.ms, self.n)
-        self.losoto_a = 'losoto {0}instrument_a{1}.h5 {2}'.format(self.ms, self.n,self.ampname)
-        with open(self.ampname, 'w') as handle:
-            for line in data:
-                handle.write(line)
-
-        with open(self.pset_loc + 'lsslow.pset', 'r') as handle:
-            data = [line for line in handle]
-        data[-1] = 'prefix = {0}/losoto/apcal{1}/slowphase'.format(self.ms, self.n)
-        self.losoto_slow = 'losoto {0}instrument_a{1}.h5 {2}'.format(self.ms, self.n, self.slowphasename)
-        with open(self.slowphasename, 'w') as handle:
-            for line in data:
-                handle.write(line)
-
     def _init_parsets(self):
         ddecal = parse_pset(self.pset_loc + 'ddecal_init.pset')
         acal = parse_pset(self.pset_loc + 'acal_init.pset')
@@ -96,6 +95,7 @@ class DiagonalCalibrator(object):
         acal.append('msout.datacolumn=CORRECTED_PHASE')
         self.ddephase = ' '.join(ddecal)
         self.aphase = ' '.join(acal)
+        self.fusedphase = ' '.join(fuse_psets(ddecal, acal))
 
         ddeamp = parse_pset(self.pset_loc + 'ddecal_ampself.pset')
         aamp = parse_pset(self.pset_loc + 'acal_ampself.pset')
@@ -108,6 +108,7 @@ class DiagonalCalibrator(object):
         aamp.append('msout.datacolumn=CORRECTED_DATA2')
         self.ddeamp = ' '.join(ddeamp)
         self.aamp = ' '.join(aamp)
+        self.fusedamp = ' '.join(fuse_psets(ddeamp, aamp))
 
     def _init_img(self):
         with open(self.pset_loc+'imaging.sh') as handle:
@@ -121,40 +122,117 @@ class DiagonalCalibrator(object):
         else:
             self.fulimg = '{0} -no-update-model-required -data-column CORRECTED_DATA2 -auto-mask 5 -auto-threshold 1.5 -name {1}{2}/ws {3}'.format(base_image, self.fpath, imname, self.ms)
     
-    def pickle_and_call(self,x):
-        self.log.add_calls(x)
-        subprocess.call(x, shell = True)
-        self.log.save()
+    def pickle_and_call(self, x, all_ms = False):
+        '''
+            Runs and journals x. Calls on all ms of the step (imaging,
+            predict) are journalled without a ms.
+        '''
+        return run_command(x, self.log, self.step, None if all_ms else self.ms or None)
 
     def run_img(self, mslist):
         '''
             Does three things:
             Firstly, it runs wsclean to generate a model.
             Next, it modifies the model to suppress negative flux
-            and to make sure the total flux matches a model (if avail)
+            and to make sure the total flux matches a model (if avail,
+            as fluxmodel.fits next to the parsets)
+            Finally, it predicts the model into the ms.
         '''
         fulimg = self.prep_img()
         imgcall = fulimg + ' '.join(mslist)
-        self.pickle_and_call(imgcall)
-        suppressNegatives('{0}/apcal{1}'.format(self.fpath, self.n))
+        # Imaging does not touch the ms (-no-update-model-required), so the
+        # images are all it produces and it can be cached
+        inputs = list(mslist)
+        if os.path.isfile('{}casamask.fits'.format(self.pset_loc)):
+            inputs.append('{}casamask.fits'.format(self.pset_loc))
+        # The predict reuses the visibilities the imaging reordered
+        reordered = ReorderCache(self.fpath)
+        cached_call(imgcall, ['{0}apcal{1}/ws-*'.format(self.fpath, self.n)],
+                    lambda call: reordered.run(call, mslist, lambda x: self.pickle_and_call(x, True)), inputs, [self.fpath], self.log)
+        reference = '{}fluxmodel.fits'.format(self.pset_loc)
+        suppressNegatives('{0}/apcal{1}'.format(self.fpath, self.n), reference if os.path.isfile(reference) else None)
         with open(self.pset_loc+'predicting.sh') as handle:
             base_predict = handle.read()[:-2]
-        base_predict += ' -name {0}/apcal{1}/ws {2}'.format(self.fpath, self.n, ' '.join(mslist))
-        self.pickle_and_call(base_predict)
+        base_predict += ' -data-column CORRECTED_DATA2 -name {0}/apcal{1}/ws {2}'.format(self.fpath, self.n, ' '.join(mslist))
+        reordered.run(base_predict, mslist, lambda x: self.pickle_and_call(x, True))
 
-    def calibrate(self):
+    def solve(self):
+        '''
+            The amplitude solve needs the phase corrected data, so this
+            also applies the phase solutions
+        '''
         self._init_parsets()
-        self._init_losoto()
-        self.pickle_and_call('DPPP {}'.format(self.ddephase))
+        h5_p, h5_a = self.artefacts('solve')
+        cached_call('DPPP {}'.format(self.ddephase), [h5_p], self.pickle_and_call, [self.ms], log = self.log)
         self.pickle_and_call('DPPP {}'.format(self.aphase))
-        self.pickle_and_call('DPPP {}'.format(self.ddeamp))
+        cached_call('DPPP {}'.format(self.ddeamp), [h5_a], self.pickle_and_call, [self.ms], log = self.log)
+
+    def apply(self):
+        self._init_parsets()
         self.pickle_and_call('DPPP {}'.format(self.aamp))
-        self.pickle_and_call(self.losoto_p)
-        self.pickle_and_call(self.losoto_a)
-        self.pickle_and_call(self.losoto_slow)
-        os.remove(self.prephasename)
-        os.remove(self.ampname)
-        os.remove(self.slowphasename)
+
+    def solve_apply(self):
+        '''
+            Two passes over the ms instead of four: the phase solve that
+            applies its solutions, then the amplitude solve that does
+        '''
+        self._init_parsets()
+        h5_p, h5_a = self.artefacts('solve')
+        cached_fused_call('DPPP {}'.format(self.ddephase), 'DPPP {}'.format(self.fusedphase), 'DPPP {}'.format(self.aphase),
+                          [h5_p], self.pickle_and_call, [self.ms], log = self.log)
+        cached_fused_call('DPPP {}'.format(self.ddeamp), 'DPPP {}'.format(self.fusedamp), 'DPPP {}'.format(self.aamp),
+                          [h5_a], self.pickle_and_call, [self.ms], log = self.log)
+
+    def plot(self):
+        outdir = self.artefacts('plot')[0]
+        makedir(outdir)
+        h5_p, h5_a = self.artefacts('solve')
+        plot_h5parm(h5_p, [(read_plot_pset(self.pset_loc + 'lstp.pset'), outdir + 'prephase')])
+        plot_h5parm(h5_a, [(read_plot_pset(self.pset_loc + 'lsta.pset'), outdir + 'amp'),
+                           (read_plot_pset(self.pset_loc + 'lsslow.pset'), outdir + 'slowphase')])
+
+    def artefacts(self, stage):
+        '''
+            Files a stage leaves behind, used to check that a finished
+            stage is still complete when a run is resumed
+        '''
+        if stage == 'solve':
+            return ['{0}instrument_p{1}.h5'.format(self.ms, self.n), '{0}instrument_a{1}.h5'.format(self.ms, self.n)]
+        elif stage == 'plot':
+            return ['{0}/losoto/apcal{1}/'.format(self.ms, self.n)]
+        elif stage == 'image':
+            return ['{0}apcal{1}/'.format(self.fpath, self.n)]
+        return []
+
+    def commands(self, stage, mslist = None):
+        '''
+            The calls of a stage without running them, for planner.py. Work
+            done in python is a comment. Whether wsclean saves or reuses the
+            reordered data is decided when the image runs.
+        '''
+        self._init_parsets()
+        if stage == 'solve':
+            return ['DPPP {}'.format(self.ddephase), 'DPPP {}'.format(self.aphase), 'DPPP {}'.format(self.ddeamp)]
+        elif stage == 'apply':
+            return ['DPPP {}'.format(self.aamp)]
+        elif stage == 'solve_apply':
+            return ['DPPP {}'.format(self.fusedphase), 'DPPP {}'.format(self.fusedamp)]
+        elif stage == 'plot':
+            return ['# plot {0} {1} in {2}'.format(*(self.artefacts('solve') + self.artefacts('plot')))]
+        elif stage == 'image':
+            ms, self.ms = self.ms, ''
+            self._init_img()
+            self.ms = ms
+            with open(self.pset_loc+'predicting.sh') as handle:
+                base_predict = handle.read()[:-2]
+            base_predict += ' -data-column CORRECTED_DATA2 -name {0}/apcal{1}/ws {2}'.format(self.fpath, self.n, ' '.join(mslist))
+            return [self.fulimg + ' '.join(mslist), '# suppress negatives in {0}/apcal{1}'.format(self.fpath, self.n), base_predict]
+        return []
+
+    def calibrate(self):
+        self.solve()
+        self.apply()
+        self.plot()
     
     def prep_img(self):
         self._init_dir()
@@ -162,36 +240,11 @@ class DiagonalCalibrator(object):
         self._init_img()
         return self.fulimg
 
-    def _printrun(self):
-        '''
-            Basically prints all commands, without running it
-        '''
-        with open('kittens.fl', 'a') as handle:
-            handle.write('DPPP {}\n'.format(self.ddephase))
-            handle.write('DPPP {}\n'.format(self.aphase))
-            handle.write('DPPP {}\n'.format(self.ddeamp))
-            handle.write('DPPP {}\n'.format(self.aamp))
-            handle.write(self.fulimg+'\n')
-            self._init_losoto()
-            handle.write(self.losoto_p+'\n')
-            handle.write(self.losoto_a)
-
-    def _actualrun(self):
+    def execute(self):
         self.pickle_and_call('DPPP {}'.format(self.ddephase))
         self.pickle_and_call('DPPP {}'.format(self.aphase))
         self.pickle_and_call('DPPP {}'.format(self.ddeamp))
         process_diag('{0}instrument_a{1}.h5'.format(self.ms,self.n))
         self.pickle_and_call('DPPP {}'.format(self.aamp))
         self.pickle_and_call(self.fulimg)
-        self._init_losoto()
-        self.pickle_and_call(self.losoto_p)
-        self.pickle_and_call(self.losoto_a)
-        self.pickle_and_call(self.losoto_slow)
-
-
-    def execute(self):
-        if self.DEBUG:
-            self._printrun()
-        else:
-            self._actualrun()
-    
+        self.plot()
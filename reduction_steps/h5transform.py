@@ -0,0 +1,154 @@
+from __future__ import print_function
+import numpy as np
+from losoto import h5parm
+
+'''
+    Post-processing of h5parms in place. Operations on the soltabs of a
+    solset are collected first and then applied in a single pass over the
+    file, reading and writing blocks of time slots straight from the HDF5
+    arrays, so multi-GB solution tables never have to fit in memory.
+
+        H5Transform(fname).set('phase000', 0., stations = 'remote+international').run()
+'''
+
+CHUNK = 256*1024**2
+
+# Station classes by the substring in the antenna name
+STATIONS = {'core': 'CS', 'remote': 'RS'}
+
+_masks = {}
+
+def antenna_masks(antennas):
+    '''
+        Boolean masks of the core, remote and international stations.
+        Cached per list of antennas, which is the same for all h5parms of
+        an observation.
+    '''
+    key = tuple(antennas)
+    if key not in _masks:
+        names = np.array(antennas).astype(str)
+        masks = {}
+        for name, code in STATIONS.items():
+            masks[name] = np.char.find(names, code) >= 0
+        masks['international'] = ~(masks['core'] | masks['remote'])
+        _masks[key] = masks
+    return _masks[key]
+
+def station_mask(antennas, stations):
+    '''
+        Mask of a station class, or of several joined by a +, e.g.
+        'remote+international'
+    '''
+    masks = antenna_masks(antennas)
+    mask = np.zeros(len(antennas), dtype = bool)
+    for name in stations.split('+'):
+        mask |= masks[name]
+    return mask
+
+def _time_block(ndim, taxis, start, end):
+    index = [slice(None)]*ndim
+    index[taxis] = slice(start, end)
+    return tuple(index)
+
+class H5Transform(object):
+    def __init__(self, fname, solset = 'sol000', chunk_bytes = CHUNK):
+        self.fname = fname
+        self.solset = solset
+        self.chunk_bytes = chunk_bytes
+        self.ops = []
+
+    def set(self, soltab, value, stations = None, **select):
+        '''
+            Sets the values of a station class (all stations if None) to
+            value. select fixes other axes by index, e.g. dir = 0.
+        '''
+        self.ops.append((soltab, 'set', (value, stations, select)))
+        return self
+
+    def normalise(self, soltab, axis = 'freq'):
+        '''
+            Scales the values to a mean of 1 along every index of axis,
+            ignoring NaNs
+        '''
+        self.ops.append((soltab, 'normalise', axis))
+        return self
+
+    def run(self):
+        H5 = h5parm.h5parm(self.fname, readonly = False)
+        try:
+            solset = H5.getSolset(self.solset)
+            soltabs = []
+            for name, kind, args in self.ops:
+                if name not in soltabs:
+                    soltabs.append(name)
+            for name in soltabs:
+                self._transform(solset.getSoltab(name), [(kind, args) for tab, kind, args in self.ops if tab == name])
+        finally:
+            H5.close()
+        self.ops = []
+
+    def _transform(self, soltab, ops):
+        axes = soltab.getAxesNames()
+        val = soltab.obj.val
+        taxis = axes.index('time')
+        ntimes = val.shape[taxis]
+        slot = val.dtype.itemsize*int(np.prod(val.shape))//max(1, ntimes)
+        step = max(1, int(self.chunk_bytes//max(1, slot)))
+        blocks = [_time_block(len(axes), taxis, start, min(ntimes, start + step)) for start in range(0, ntimes, step)]
+        # Turn the ops into functions on a block. A normalisation needs the
+        # means of the data as the ops before it leave them, which costs an
+        # extra read of the soltab unless it fits in a single block.
+        data = val[blocks[0]] if len(blocks) == 1 else None
+        funcs = []
+        for kind, args in ops:
+            if kind == 'set':
+                value, stations, select = args
+                index = [slice(None)]*len(axes)
+                if stations is not None:
+                    index[axes.index('ant')] = station_mask(soltab.getAxisValues('ant'), stations)
+                for axis, idx in select.items():
+                    index[axes.index(axis)] = idx
+                func = self._setter(tuple(index), value)
+            elif data is not None:
+                func = self._scaler(self._scale([data], axes, args))
+            else:
+                func = self._scaler(self._scale((self._replay(val[block], funcs) for block in blocks), axes, args))
+            if data is not None:
+                func(data)
+            funcs.append(func)
+        if data is not None:
+            val[blocks[0]] = data
+            return
+        for block in blocks:
+            val[block] = self._replay(val[block], funcs)
+
+    def _replay(self, data, funcs):
+        for func in funcs:
+            func(data)
+        return data
+
+    def _setter(self, index, value):
+        def func(data):
+            data[index] = value
+        return func
+
+    def _scaler(self, scale):
+        def func(data):
+            data *= scale
+        return func
+
+    def _scale(self, blocks, axes, axis):
+        '''
+            Factors that bring the mean along axis of the data in blocks to 1
+        '''
+        naxis = axes.index(axis)
+        others = tuple(i for i in range(len(axes)) if i != naxis)
+        total = 0.
+        count = 0.
+        for data in blocks:
+            total = total + np.nansum(data, axis = others)
+            count = count + np.sum(~np.isnan(data), axis = others)
+        shape = [1]*len(axes)
+        shape[naxis] = -1
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            return (count/total).reshape(shape)
@@ -3,51 +3,47 @@ import numpy as np
 import sys
 import os
 import lin2circ
-import shutil
-import subprocess
 import journal_pickling as jp
+from runner import run_command
 from .tools import parse_pset
 
-class FakeLinParser(object):
-    def __init__(self, inms, column, back, poltable, outcol, lincol):
-        self.inms = inms
-        self.column = column
-        self.back = back
-        self.poltable = poltable
-        self.outcol = outcol
-        self.lincol = lincol
-
 class LinToCirc(object):
-    def __init__(self, n, ms, fpath, pset_loc = './'):
+    def __init__(self, n, ms, fpath, pset_loc = './', jobs = 1, dysco = True):
         self.n = n
         self.ms = ms
         self.fpath = fpath
         self.initialized = False
         self.pset_loc = pset_loc
         self.log = jp.Locker(fpath+'log')
-        self.DEBUG = False
+        self.step = 'l{}'.format(n)
         self.callist = []
+        self.jobs = jobs
+        self.dysco = dysco
         assert fpath[-1] == '/'
         assert ms[-1] == '/'
         assert pset_loc[-1] == '/'
 
     def run_lin2circ(self):
-        options = FakeLinParser(self.ms, 'DATA', False, False, 'DATA_CIRC', 'DATA_LIN')
-        lin2circ.main(options)
-        self.pickle_and_call("DPPP msin={0} msout={0}CRC msout.storagemanager=dysco msout.writefullresflag=false msin.datacolumn=DATA_CIRC msout.datacolumn=DATA steps=[]".format(self.ms[:-1]))
-        shutil.move('{}CRC'.format(self.ms[:-1]),self.ms)
+        '''
+            Converts DATA to circular in place and updates the POLARIZATION
+            table, in a single pass over the visibilities. A ms that is
+            already circular (e.g. on a rerun) is left alone.
+        '''
+        if lin2circ.get_corr_type(self.ms) == lin2circ.CORR_TYPES['circular']:
+            print('==== {} is already circular, not converting'.format(self.ms))
+            return
+        self.log.add_calls('lin2circ.convert_ms {0} lin2circ DATA->DATA jobs={1} dysco={2}'.format(self.ms, self.jobs, self.dysco), self.step, self.ms)
+        lin2circ.convert_ms(self.ms, 'lin2circ', 'DATA', 'DATA', corr_type = lin2circ.CORR_TYPES['circular'], jobs = self.jobs, dysco = self.dysco)
     
     def calibrate(self):
         self.run_lin2circ()
 
-    def pickle_and_call(self,x):
-        self.log.add_calls(x)
-        subprocess.call(x, shell = True)
-        self.log.save()
+    def commands(self, stage = 'lin2circ', mslist = None):
+        '''
+            The conversion without running it, for planner.py. It is done
+            in python, so it is a comment.
+        '''
+        return ['# lin2circ.convert_ms {0} lin2circ DATA->DATA jobs={1} dysco={2}'.format(self.ms, self.jobs, self.dysco)]
 
-    def execute(self):
-        if self.DEBUG:
-            self._printrun()
-        else:
-            self._actualrun()
-    
+    def pickle_and_call(self,x):
+        return run_command(x, self.log, self.step, self.ms or None)
@@ -2,9 +2,13 @@ from __future__ import print_function
 import numpy as np
 import sys
 import os
-import subprocess
 import journal_pickling as jp
+from runner import run_command
+from cache import cached_call, cached_fused_call
 from .tools import parse_pset
+from .tools import fuse_psets
+from .tools import makedir
+from .plotting import plot_h5parm, read_plot_pset
 
 class PhaseCalibrator(object):
     def __init__(self, n, ms, fpath, pset_loc = './'):
@@ -14,7 +18,7 @@ class PhaseCalibrator(object):
         self.initialized = False
         self.pset_loc = pset_loc
         self.log = jp.Locker(fpath+'log')
-        self.DEBUG = False
+        self.step = 'p{}'.format(n)
         self.callist = []
         assert fpath[-1] == '/'
         assert ms[-1] == '/'
@@ -35,28 +39,6 @@ class PhaseCalibrator(object):
         except OSError:
             pass
 
-    def _init_losoto(self):
-        '''
-            This needs to be ran right before calling it.
-            It changes the losoto parset and can conflict if not ran
-            immediately afterwards.
-        '''
-        np.random.seed(np.abs(hash(self.ms)%2**31))
-        with open(self.pset_loc + 'lstp.pset', 'r') as handle:
-            data = [line for line in handle]
-        self.psetname = '{:05d}'.format(np.random.randint(20000))
-        print(self.psetname)
-        os.mkdir('{0}/losoto/pcal{1}/'.format(self.ms, self.n))
-        if self.n == 0:
-            data[-1] = 'prefix = {0}/losoto/pcal{1}/'.format(self.ms, self.n)
-            self.losoto = 'losoto {0}instrument.h5 {1}'.format(self.ms, self.psetname)
-        else:
-            data[-1] = 'prefix = {0}/losoto/pcal{1}/'.format(self.ms, self.n)
-            self.losoto = 'losoto {0}instrument_{1}.h5 {2}'.format(self.ms, self.n, self.psetname)
-        with open(self.psetname, 'w') as handle:
-            for line in data:
-                handle.write(line)
-
     def _init_parsets(self):
         ddecal = parse_pset(self.pset_loc + 'ddecal_init.pset')
         acal = parse_pset(self.pset_loc + 'acal_init.pset')
@@ -72,6 +54,7 @@ class PhaseCalibrator(object):
             acal.append('applycal.parmdb={0}instrument_{1}.h5'.format(self.ms,self.n))
         self.ddecal = ' '.join(ddecal)
         self.acal = ' '.join(acal)
+        self.fused = ' '.join(fuse_psets(ddecal, acal))
 
     def _init_img(self):
         with open(self.pset_loc+'imaging.sh') as handle:
@@ -85,21 +68,77 @@ class PhaseCalibrator(object):
         else:
             self.fulimg = '{0} -data-column CORRECTED_DATA -auto-mask 5 -auto-threshold 1.5 -name {1}{2}/ws {3}'.format(base_image, self.fpath, imname, self.ms)
 
-    def pickle_and_call(self,x):
-        self.log.add_calls(x)
-        subprocess.call(x, shell = True)
-        self.log.save()
+    def pickle_and_call(self, x, all_ms = False):
+        '''
+            Runs and journals x. Calls on all ms of the step (imaging,
+            predict) are journalled without a ms.
+        '''
+        return run_command(x, self.log, self.step, None if all_ms else self.ms or None)
+
+    def solve(self):
+        self._init_parsets()
+        cached_call('DPPP {}'.format(self.ddecal), self.artefacts('solve'), self.pickle_and_call, [self.ms], log = self.log)
+
+    def apply(self):
+        self._init_parsets()
+        self.pickle_and_call('DPPP {}'.format(self.acal))
+
+    def solve_apply(self):
+        '''
+            solve and apply in a single pass over the ms
+        '''
+        self._init_parsets()
+        cached_fused_call('DPPP {}'.format(self.ddecal), 'DPPP {}'.format(self.fused), 'DPPP {}'.format(self.acal),
+                          self.artefacts('solve'), self.pickle_and_call, [self.ms], log = self.log)
+
+    def plot(self):
+        outdir = self.artefacts('plot')[0]
+        makedir(outdir)
+        plot_h5parm(self.artefacts('solve')[0], [(read_plot_pset(self.pset_loc + 'lstp.pset'), outdir)])
+
+    def artefacts(self, stage):
+        '''
+            Files a stage leaves behind, used to check that a finished
+            stage is still complete when a run is resumed
+        '''
+        if stage == 'solve':
+            if self.n == 0:
+                return ['{0}instrument.h5'.format(self.ms)]
+            return ['{0}instrument_{1}.h5'.format(self.ms, self.n)]
+        elif stage == 'plot':
+            return ['{0}/losoto/pcal{1}/'.format(self.ms, self.n)]
+        elif stage == 'image':
+            return ['{0}{1}/'.format(self.fpath, 'init' if self.n == 0 else 'pcal{}'.format(self.n))]
+        return []
+
+    def commands(self, stage, mslist = None):
+        '''
+            The calls of a stage without running them, for planner.py. Work
+            done in python is a comment.
+        '''
+        self._init_parsets()
+        if stage == 'solve':
+            return ['DPPP {}'.format(self.ddecal)]
+        elif stage == 'apply':
+            return ['DPPP {}'.format(self.acal)]
+        elif stage == 'solve_apply':
+            return ['DPPP {}'.format(self.fused)]
+        elif stage == 'plot':
+            return ['# plot {0} in {1}'.format(self.artefacts('solve')[0], self.artefacts('plot')[0])]
+        elif stage == 'image':
+            ms, self.ms = self.ms, ''
+            self._init_img()
+            self.ms = ms
+            return [self.fulimg + ' '.join(mslist)]
+        return []
 
     def calibrate(self):
         '''
             Only run the calibration, not any imaging 
         '''
-        self._init_parsets()
-        self._init_losoto()
-        self.pickle_and_call('DPPP {}'.format(self.ddecal))
-        self.pickle_and_call('DPPP {}'.format(self.acal))
-        self.pickle_and_call(self.losoto)
-        os.remove(self.psetname)
+        self.solve()
+        self.apply()
+        self.plot()
    
     def prep_img(self):
         '''
@@ -111,29 +150,8 @@ class PhaseCalibrator(object):
         self._init_img()
         return self.fulimg
 
-
-    def _printrun(self):
-        '''
-            Basically prints all commands, without running it
-        '''
-        with open('kittens.fl', 'a') as handle:
-            handle.write('DPPP {}\n'.format(self.ddecal))
-            handle.write('DPPP {}\n'.format(self.acal))
-            handle.write(self.fulimg+'\n')
-            self._init_losoto()
-            handle.write(self.losoto+'\n')
-
-    def _actualrun(self):
+    def execute(self):
         self.pickle_and_call('DPPP {}'.format(self.ddecal))
         self.pickle_and_call('DPPP {}'.format(self.acal))
         self.pickle_and_call(self.fulimg)
-        self._init_losoto()
-        self.pickle_and_call(self.losoto)
-
-
-    def execute(self):
-        if self.DEBUG:
-            self._printrun()
-        else:
-            self._actualrun()
-    
+        self.plot()
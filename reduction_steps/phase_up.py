@@ -2,36 +2,41 @@ from __future__ import print_function
 import numpy as np
 import sys
 import os
-import subprocess
 import journal_pickling as jp
+from runner import run_command
 import shutil as shu
+import pyrap.tables as pt
 import diag_cal as dc
 import predict as pr
-from losoto import h5parm
+from .h5transform import H5Transform
 from .tools import parse_pset
+from .tools import makedir
+from .plotting import plot_h5parm, read_plot_pset
 
 
 class PhaseUp(object):
-    def __init__(self, n, ms, fpath, pset_loc = './', predict_path = './model.fits'):
+    def __init__(self, n, ms, fpath, pset_loc = './', predict_path = './model.fits', backup = False):
         self.ms = ms
+        self.backup = backup
         self.fpath = fpath
         self.initialized = False
         self.pset_loc = pset_loc
         self.log = jp.Locker(fpath+'log')
+        self.step = 'u{}'.format(n)
         self.predict_path = predict_path
-        self.DEBUG = False
         assert fpath[-1] == '/'
         assert ms[-1] == '/'
         assert pset_loc[-1] == '/'
         assert n == 1
 
     def initialize(self):
+        self._restore()
         self._init_parsets()
         self._init_dir()
         self.initialized = True
     
     def _init_dir(self):
-        os.mkdir('{}phaseup'.format(self.fpath))
+        makedir('{}phaseup'.format(self.fpath))
 
     def _init_parsets(self):
         ddecal = parse_pset(self.pset_loc + 'phaseup.pset')
@@ -63,98 +68,111 @@ class PhaseUp(object):
         acal_diag.append('applycal.parmdb={}prephase2.h5'.format(self.ms))
         self.acal_diag = ' '.join(acal_diag)
 
-    def _init_losoto(self):
+    def plot(self):
         '''
-            This needs to be ran right before calling it.
-            It changes the losoto parset and can conflict if not ran
-            immediately afterwards.
+            Plots the solutions of the diagonal prephase solve, if it ran.
+            The plots of every ms get their own prefix, so that phase-ups
+            of several ms can run at the same time.
         '''
-        with open(self.pset_loc + 'lsupp.pset', 'r') as handle:
-            data = [line for line in handle]
-        os.remove(self.pset_loc + 'lsupp.pset')
-        data[-1] = 'prefix = {0}phaseup/'.format(self.fpath)
-        self.losoto_p = 'losoto {0}prephase2.h5 {1}lsupp.pset'.format(self.ms, self.pset_loc)
-        with open(self.pset_loc + 'lsupp.pset', 'w') as handle:
-            for line in data:
-                handle.write(line)
-        # Technically, lsupa.pset is completely unneccesary
-        with open(self.pset_loc + 'lsupa.pset', 'r') as handle:
-            data = [line for line in handle]
-        os.remove(self.pset_loc + 'lsupa.pset')
-        data[-1] = 'prefix = {0}phaseup/amp'.format(self.fpath)
-        self.losoto_a = 'losoto {0}prephase2.h5 {1}lsupa.pset'.format(self.ms,self.pset_loc)
-        with open(self.pset_loc + 'lsupa.pset', 'w') as handle:
-            for line in data:
-                handle.write(line)
+        h5 = '{}prephase2.h5'.format(self.ms)
+        if not os.path.isfile(h5):
+            print('==== No {}, not plotting'.format(h5))
+            return
+        prefix = '{0}phaseup/{1}_'.format(self.fpath, os.path.basename(self.ms.rstrip('/')))
+        plot_h5parm(h5, [(read_plot_pset(self.pset_loc + 'lsupp.pset'), prefix)])
 
     def pickle_and_call(self,x):
-        self.log.add_calls(x)
-        subprocess.call(x, shell = True)
-        self.log.save()
+        return run_command(x, self.log, self.step, self.ms or None)
+
+    def phased_up(self):
+        '''
+            True if the ms already has the superstation that phaseup.pset
+            adds, e.g. when a phase-up died after fix_folders
+        '''
+        t = pt.table('{}ANTENNA'.format(self.ms), ack = False)
+        names = t.getcol('NAME')
+        t.close()
+        return 'ST001' in names
+
+    def _restore(self):
+        '''
+            An interrupted fix_folders can leave the ms only as its backup
+        '''
+        ms = self.ms.rstrip('/')
+        if not os.path.isdir(ms) and os.path.isdir('{}_prepu'.format(ms)):
+            print('==== Restoring {0} from {0}_prepu'.format(ms))
+            os.rename('{}_prepu'.format(ms), ms)
+
+    def _check_backup(self):
+        '''
+            An existing <ms>_prepu/ may be the only copy of the ms from
+            before any phase-up, so it is never overwritten
+        '''
+        old = '{}_prepu'.format(self.ms.rstrip('/'))
+        if os.path.isdir(old):
+            raise IOError('{} already exists, move it away before phasing up again'.format(old))
 
     def fix_folders(self):
-        shu.rmtree(self.ms)
-        shu.copytree('{}_pu/'.format(self.ms[:-1]), self.ms)
-        shu.rmtree('{}_pu/'.format(self.ms[:-1]))
+        '''
+            Swaps the phased up ms into the place of the original with two
+            renames in the same folder. The original is kept as <ms>_prepu/
+            if backup is set.
+        '''
+        self._check_backup()
+        ms = self.ms.rstrip('/')
+        phased = '{}_pu'.format(ms)
+        old = '{}_prepu'.format(ms)
+        os.rename(ms, old)
+        try:
+            os.rename(phased, ms)
+        except OSError:
+            os.rename(old, ms)
+            raise
+        if not self.backup:
+            shu.rmtree(old)
 
     def fix_h5(self, parmname, also_amp = False):
         '''
             THIS FUNCTION IS MISBEHAVING
         '''
-        H5 = h5parm.h5parm(self.ms + parmname, readonly = False) 
-        phases = H5.getSolset('sol000').getSoltab('phase000').getValues()
-        phasevals = phases[0]
-        antennas = phases[1]['ant']
-        # Select ids of international, remote and both
-        idx_rem_int = np.where([not 'CS' in ant for ant in antennas])
-        idx_int = np.where([not ('CS' in ant or 'RS' in ant) for ant in antennas])
-        idx_rem = np.where(['RS' in ant for ant in antennas])
-        phasevals[:,:,idx_rem_int,:,:] = 0.0 # Try setting all directions?
+        transform = H5Transform(self.ms + parmname)
+        transform.set('phase000', 0.0, stations = 'remote+international') # Try setting all directions?
         if also_amp:
-            ampvals = H5.getSolset('sol000').getSoltab('amplitude000').getValues()[0]
-            ampvals[:,:,idx_rem,0,:] = 1.0 
-            ampvals[:,:,idx_int,0,:] = 2.0
-            H5.getSolset('sol000').getSoltab('amplitude000').setValues(ampvals)
-        H5.getSolset('sol000').getSoltab('phase000').setValues(phasevals)
-        H5.close()
-
-    def _printrun(self):
+            transform.set('amplitude000', 1.0, stations = 'remote', dir = 0)
+            transform.set('amplitude000', 2.0, stations = 'international', dir = 0)
+        transform.run()
+
+    def commands(self, stage = 'phaseup', mslist = None):
         '''
-            Basically prints all commands, without running it
+            The calls of the phase-up without running them, for planner.py.
+            Work done in python is a comment.
         '''
-        with open('kittens.fl', 'a') as handle:
-            handle.write('DPPP {}\n'.format(self.ddecal2))
-            handle.write('DPPP {}\n'.format(self.acal2))
-            handle.write(self.fulimg1+'\n')
-            handle.write('DPPP {}\n'.format(self.ddecal_diag))
-            handle.write('DPPP {}\n'.format(self.acal_diag))
-            handle.write(self.fulimg2+'\n')
-            self._init_losoto()
-            handle.write(self.losoto_p+'\n')
-            handle.write(self.losoto_a+'\n')
-            handle.write('DPPP {}\n'.format(self.ddecal_pu))
-            handle.write(self.predict_call+'\n')
-
-    def _actualrun(self):
-        self.pickle_and_call('DPPP {}'.format(self.ddecal2))
-        self.fix_h5('prephase.h5')
-        self.pickle_and_call('DPPP {}'.format(self.acal2))
-        # self.pickle_and_call('DPPP {}'.format(self.ddecal_diag))
-        # self.fix_h5('prephase2.h5', True)
-        # self.pickle_and_call('DPPP {}'.format(self.acal_diag))
-        self._init_losoto()
-        self.pickle_and_call(self.losoto_p)
-        # self.pickle_and_call(self.losoto_a)
-        self.pickle_and_call('DPPP {}'.format(self.ddecal_pu))
-        self.fix_folders()
+        self._init_parsets()
+        ms = self.ms.rstrip('/')
         predictor = pr.Predictor(self.ms, self.predict_path, self.fpath, self.pset_loc)
-        predictor.initialize()
-        predictor.execute()
-        os.mkdir('{}/losoto'.format(self.ms))
+        return ['DPPP {}'.format(self.ddecal2),
+                '# zero the remote and international phases of {}prephase.h5'.format(self.ms),
+                'DPPP {}'.format(self.acal2),
+                '# plot {}prephase2.h5 (if it exists)'.format(self.ms),
+                'DPPP {}'.format(self.ddecal_pu),
+                '# swap {0}_pu into the place of {0}{1}'.format(ms, ', keeping {}_prepu'.format(ms) if self.backup else '')
+               ] + predictor.commands()
 
     def execute(self):
-        if self.DEBUG:
-            self._printrun()
+        if self.phased_up():
+            print('==== {} is already phased up, only predicting'.format(self.ms))
         else:
-            self._actualrun()
-    
+            self._check_backup()
+            self.pickle_and_call('DPPP {}'.format(self.ddecal2))
+            self.fix_h5('prephase.h5')
+            self.pickle_and_call('DPPP {}'.format(self.acal2))
+            # self.pickle_and_call('DPPP {}'.format(self.ddecal_diag))
+            # self.fix_h5('prephase2.h5', True)
+            # self.pickle_and_call('DPPP {}'.format(self.acal_diag))
+            self.plot()
+            self.pickle_and_call('DPPP {}'.format(self.ddecal_pu))
+            self.fix_folders()
+        predictor = pr.Predictor(self.ms, self.predict_path, self.fpath, self.pset_loc)
+        predictor.initialize()
+        predictor.execute()
+        makedir('{}/losoto'.format(self.ms))
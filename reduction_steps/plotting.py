@@ -0,0 +1,145 @@
+from __future__ import print_function
+import os
+import itertools
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+from losoto import h5parm
+
+'''
+    Solution plots without starting losoto. The options are read from the
+    same ls*.pset files that were passed to losoto (soltab, axesInPlot,
+    axisInTable, refant), every h5parm is read once for all the plots made
+    from it, and the figures are rendered with the Agg backend. A plot
+    stage only reads its own h5parm, so the plots of all ms run in
+    parallel on the pool of DP5.py.
+'''
+
+PHASE_TYPES = ('phase', 'scalarphase', 'rotation')
+
+# Soltabs read in this process, so the second plot of a h5parm (e.g. the
+# amplitudes and slow phases of a diagonal solve) does not read it again
+_soltabs = {}
+
+def read_plot_pset(fname):
+    '''
+        The options of a losoto PLOT parset that are used here, with
+        losoto's defaults. Keys are lower case.
+    '''
+    options = {'soltab': None, 'axesinplot': ['time'], 'axisintable': None, 'refant': None}
+    with open(fname, 'r') as handle:
+        for line in handle:
+            line = line.split('#')[0].strip()
+            if '=' not in line or line.startswith('['):
+                continue
+            key, value = [part.strip() for part in line.split('=', 1)]
+            value = value.strip('\'"')
+            if value.startswith('['):
+                value = [item.strip().strip('\'"') for item in value.strip('[]').split(',') if item.strip()]
+            options[key.lower()] = value
+    if isinstance(options['soltab'], str):
+        options['soltab'] = [options['soltab']]
+    if isinstance(options['axesinplot'], str):
+        options['axesinplot'] = [options['axesinplot']]
+    return options
+
+def read_soltabs(fname, names = None):
+    '''
+        Values (flagged ones set to NaN), axes and type of the soltabs
+        names ('solset/soltab'), all of them if None
+    '''
+    key = (fname, os.path.getmtime(fname))
+    if key not in _soltabs:
+        _soltabs.clear()
+        _soltabs[key] = {}
+    cached = _soltabs[key]
+    missing = [name for name in names if name not in cached] if names else None
+    if missing or names is None:
+        H5 = h5parm.h5parm(fname, readonly = True)
+        try:
+            if names is None:
+                names = ['{0}/{1}'.format(solset, soltab) for solset in H5.getSolsetNames()
+                         for soltab in H5.getSolset(solset).getSoltabNames()]
+                missing = [name for name in names if name not in cached]
+            for name in missing:
+                solset, soltab = name.split('/')
+                soltab = H5.getSolset(solset).getSoltab(soltab)
+                vals, axes = soltab.getValues(retAxesVals = True)
+                weights = soltab.getValues(retAxesVals = False, weight = True)
+                vals = np.array(vals, dtype = float)
+                vals[np.asarray(weights) == 0] = np.nan
+                cached[name] = (vals, soltab.getAxesNames(), axes, soltab.getType())
+        finally:
+            H5.close()
+    return [(name, cached[name]) for name in names]
+
+def _reference(vals, axes, values, refant):
+    ant = axes.index('ant')
+    names = [str(name) for name in values['ant']]
+    if refant not in names:
+        return vals
+    ref = np.take(vals, [names.index(refant)], axis = ant)
+    return np.angle(np.exp(1j*(vals - ref)))
+
+def plot_soltab(name, soltab, options, prefix):
+    '''
+        Renders one soltab like losoto's PLOT operation: a figure for every
+        combination of the axes that are neither plotted nor in the table,
+        with a panel for every value of axisInTable. Returns the file names.
+    '''
+    vals, axes, values, kind = soltab
+    inplot = [axis for axis in options['axesinplot'] if axis in axes]
+    table = options['axisintable'] if options['axisintable'] in axes else None
+    if kind in PHASE_TYPES and options['refant'] and 'ant' in axes:
+        vals = _reference(vals, axes, values, options['refant'])
+    loop = [axis for axis in axes if axis not in inplot and axis != table]
+    order = loop + ([table] if table else []) + inplot
+    vals = np.transpose(vals, [axes.index(axis) for axis in order])
+    if kind in PHASE_TYPES:
+        vmin, vmax = -np.pi, np.pi
+    else:
+        vmin, vmax = np.nanmin(vals), np.nanmax(vals)
+    fnames = []
+    for index in itertools.product(*[range(len(values[axis])) for axis in loop]):
+        panels = vals[index] if table else vals[index][np.newaxis]
+        labels = [str(label) for label in values[table]] if table else ['']
+        ncol = int(np.ceil(np.sqrt(len(panels))))
+        nrow = int(np.ceil(len(panels)/float(ncol)))
+        fig, subs = plt.subplots(nrow, ncol, figsize = (3*ncol, 2.5*nrow), sharex = True, sharey = True, squeeze = False)
+        for sub, panel, label in zip(subs.flat, panels, labels):
+            if len(inplot) == 2:
+                extent = [values[inplot[0]][0], values[inplot[0]][-1], values[inplot[1]][0], values[inplot[1]][-1]]
+                sub.imshow(panel.T, origin = 'lower', aspect = 'auto', extent = extent, vmin = vmin, vmax = vmax, interpolation = 'nearest')
+            else:
+                sub.plot(values[inplot[0]], panel, ',' if len(panel) > 1000 else '.')
+                sub.set_ylim(vmin, vmax)
+            sub.set_title(label, fontsize = 8)
+        for sub in subs.flat[len(panels):]:
+            sub.axis('off')
+        suffix = ''.join('_{0}{1}'.format(axis, values[axis][i]) for axis, i in zip(loop, index))
+        fname = '{0}{1}{2}.png'.format(prefix, name.split('/')[-1], suffix)
+        fig.suptitle('{0}{1}'.format(name, suffix.replace('_', ' ')))
+        fig.savefig(fname, bbox_inches = 'tight')
+        plt.close(fig)
+        fnames.append(fname)
+    return fnames
+
+def plot_h5parm(fname, plots):
+    '''
+        Makes every plot in plots, a list of (options, prefix) pairs, from
+        a single read of the h5parm fname
+    '''
+    names = []
+    for options, prefix in plots:
+        if options['soltab'] is None:
+            names = None
+            break
+        names += [name for name in options['soltab'] if name not in names]
+    soltabs = read_soltabs(fname, names)
+    fnames = []
+    for options, prefix in plots:
+        for name, soltab in soltabs:
+            if options['soltab'] is None or name in options['soltab']:
+                fnames += plot_soltab(name, soltab, options, prefix)
+    return fnames
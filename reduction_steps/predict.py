@@ -1,45 +1,64 @@
+import os
+import shutil
 import journal_pickling as jp
-import subprocess
+from runner import run_command
 from .tools import parse_pset
 
 class Predictor(object):
     def __init__(self, ms, pred_path, fpath, pset_loc):
         self.ms = ms
-        self.DEBUG = False
         self.pred_path = pred_path 
         self.fpath = fpath
         self.pset_loc = pset_loc
         self.log = jp.Locker(fpath+'log')
+        self.step = 'm'
+        # Temporary files of this ms only, so that predicts of several ms
+        # can run at the same time
+        self.scratch = '{0}scratch/{1}/'.format(fpath, os.path.basename(ms.rstrip('/')))
     
     def initialize(self):
         abbr_name, self.type = self.check_model_type()
+        try:
+            os.makedirs(self.scratch)
+        except OSError:
+            if not os.path.isdir(self.scratch):
+                raise
         # Make a sourcedb if it is a skymodel, then just run either wsclean predict
         # if it is a fits file or DPPP predict if it isnt
         if self.type == 'skymodel':
-            self.pickle_and_call('makesourcedb in={0}.skymodel out={0}.sourcedb'.format(abbr_name))
+            sourcedb = '{}model.sourcedb'.format(self.scratch)
+            if os.path.isdir(sourcedb):
+                shutil.rmtree(sourcedb)
+            self.pickle_and_call('makesourcedb in={0}.skymodel out={1}'.format(abbr_name, sourcedb))
+        else:
+            sourcedb = abbr_name + '.sourcedb'
         if self.type == 'fits':
-            self.call_string = 'wsclean -predict -name {0} {1}'.format(abbr_name, self.ms)
+            self.call_string = 'wsclean -predict -temp-dir {0} -name {1} {2}'.format(self.scratch, abbr_name, self.ms)
         elif self.type == 'skymodel' or self.type == 'sourcedb':
-            self._init_pset(abbr_name+'.sourcedb')
+            self._init_pset(sourcedb)
             self.call_string = 'DPPP {0}'.format(self.dppp_predict)
 
-    def _printrun(self):
-        with open('kittens.fl', 'a') as handle:
-            handle.write(self.call_string)
+    def commands(self, stage = 'predict', mslist = None):
+        '''
+            The calls of the predict without running them, for planner.py
+        '''
+        abbr_name, kind = self.check_model_type()
+        if kind == 'fits':
+            return ['wsclean -predict -temp-dir {0} -name {1} {2}'.format(self.scratch, abbr_name, self.ms)]
+        calls = []
+        sourcedb = abbr_name + '.sourcedb'
+        if kind == 'skymodel':
+            sourcedb = '{}model.sourcedb'.format(self.scratch)
+            calls.append('makesourcedb in={0}.skymodel out={1}'.format(abbr_name, sourcedb))
+        self._init_pset(sourcedb)
+        return calls + ['DPPP {0}'.format(self.dppp_predict)]
 
     def execute(self):
-        if self.DEBUG:
-            self._printrun()
-        else:
-            self._actualrun()
-
-    def _actualrun(self):
         self.pickle_and_call(self.call_string)
+        shutil.rmtree(self.scratch, ignore_errors = True)
     
     def pickle_and_call(self,x):
-        self.log.add_calls(x)
-        subprocess.call(x, shell = True)
-        self.log.save()
+        return run_command(x, self.log, self.step, self.ms or None)
 
     def check_model_type(self):
         if self.pred_path[-5:] == '.fits':
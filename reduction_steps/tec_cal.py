@@ -2,9 +2,13 @@ from __future__ import print_function
 import numpy as np
 import sys
 import os
-import subprocess
 import journal_pickling as jp
+from runner import run_command
+from cache import cached_call, cached_fused_call
 from .tools import parse_pset
+from .tools import fuse_psets
+from .tools import makedir
+from .plotting import plot_h5parm, read_plot_pset
 
 class TecCalibrator(object):
     def __init__(self, n, ms, fpath, pset_loc = './'):
@@ -14,7 +18,7 @@ class TecCalibrator(object):
         self.initialized = False
         self.pset_loc = pset_loc
         self.log = jp.Locker(fpath+'log')
-        self.DEBUG = False 
+        self.step = 't{}'.format(n)
         assert fpath[-1] == '/'
         assert ms[-1] == '/'
         assert pset_loc[-1] == '/'
@@ -26,25 +30,8 @@ class TecCalibrator(object):
         self.initialized = True
 
     def _init_dir(self):
-        os.mkdir('{0}teccal{1}'.format(self.fpath,self.n))
+        makedir('{0}teccal{1}'.format(self.fpath,self.n))
 
-    def _init_losoto(self):
-        '''
-            This needs to be ran right before calling it.
-            It changes the losoto parset and can conflict if not ran
-            immediately afterwards.
-        '''
-        np.random.seed(np.abs(hash(self.ms))%2**31)
-        with open(self.pset_loc + 'lsta.pset', 'r') as handle:
-            data = [line for line in handle]
-        self.psetname = '{:05d}'.format(np.randint(20000))
-        os.mkdir('{0}/losoto/teccal{1}'.format(self.ms, self.n))
-        data[-1] = 'prefix = {0}/losoto/teccal{1}'.format(self.fpath, self.n)
-        self.losoto = 'losoto {0}instrument_t{1}.h5 {2}'.format(self.ms, self.n, self.psetname)
-        with open(self.psetname, 'w') as handle:
-            for line in data:
-                handle.write(line)
-    
     def _init_parsets(self):
         ddecal = parse_pset(self.pset_loc + 'ddecal_teconly.pset')
         acal = parse_pset(self.pset_loc + 'acal_teconly.pset')
@@ -56,6 +43,7 @@ class TecCalibrator(object):
         acal.append('applycal.parmdb={0}instrument_t{1}.h5'.format(self.ms,self.n))
         self.ddecal = ' '.join(ddecal)
         self.acal = ' '.join(acal)
+        self.fused = ' '.join(fuse_psets(ddecal, acal))
 
     def _init_img(self):
         with open(self.pset_loc+'imaging.sh') as handle:
@@ -66,17 +54,72 @@ class TecCalibrator(object):
         else:
             self.fulimg = '{0} -data-column CORRECTED_DATA -auto-mask 5 -auto-threshold 1.5 -name {1}{2}/ws {3}'.format(base_image, self.fpath, imname, self.ms)
     
-    def pickle_and_call(self,x):
-        self.log.add_calls(x)
-        subprocess.call(x, shell = True)
-        self.log.save()
+    def pickle_and_call(self, x, all_ms = False):
+        '''
+            Runs and journals x. Calls on all ms of the step (imaging,
+            predict) are journalled without a ms.
+        '''
+        return run_command(x, self.log, self.step, None if all_ms else self.ms or None)
 
-    def calibrate(self):
+    def solve(self):
+        self._init_parsets()
+        cached_call('DPPP {}'.format(self.ddecal), self.artefacts('solve'), self.pickle_and_call, [self.ms], log = self.log)
+
+    def apply(self):
         self._init_parsets()
-        self.pickle_and_call('DPPP {}'.format(self.ddecal))
         self.pickle_and_call('DPPP {}'.format(self.acal))
-        self.pickle_and_call(self.losoto)
-        os.remove(self.psetname)
+
+    def solve_apply(self):
+        '''
+            solve and apply in a single pass over the ms
+        '''
+        self._init_parsets()
+        cached_fused_call('DPPP {}'.format(self.ddecal), 'DPPP {}'.format(self.fused), 'DPPP {}'.format(self.acal),
+                          self.artefacts('solve'), self.pickle_and_call, [self.ms], log = self.log)
+
+    def plot(self):
+        outdir = self.artefacts('plot')[0]
+        makedir(outdir)
+        plot_h5parm(self.artefacts('solve')[0], [(read_plot_pset(self.pset_loc + 'lstp.pset'), outdir)])
+
+    def artefacts(self, stage):
+        '''
+            Files a stage leaves behind, used to check that a finished
+            stage is still complete when a run is resumed
+        '''
+        if stage == 'solve':
+            return ['{0}instrument_t{1}.h5'.format(self.ms, self.n)]
+        elif stage == 'plot':
+            return ['{0}/losoto/teccal{1}/'.format(self.ms, self.n)]
+        elif stage == 'image':
+            return ['{0}teccal{1}/'.format(self.fpath, self.n)]
+        return []
+
+    def commands(self, stage, mslist = None):
+        '''
+            The calls of a stage without running them, for planner.py. Work
+            done in python is a comment.
+        '''
+        self._init_parsets()
+        if stage == 'solve':
+            return ['DPPP {}'.format(self.ddecal)]
+        elif stage == 'apply':
+            return ['DPPP {}'.format(self.acal)]
+        elif stage == 'solve_apply':
+            return ['DPPP {}'.format(self.fused)]
+        elif stage == 'plot':
+            return ['# plot {0} in {1}'.format(self.artefacts('solve')[0], self.artefacts('plot')[0])]
+        elif stage == 'image':
+            ms, self.ms = self.ms, ''
+            self._init_img()
+            self.ms = ms
+            return [self.fulimg + ' '.join(mslist)]
+        return []
+
+    def calibrate(self):
+        self.solve()
+        self.apply()
+        self.plot()
     
     def prep_img(self):
         self._init_dir()
@@ -84,28 +127,8 @@ class TecCalibrator(object):
         self._init_img()
         return self.fulimg
    
-    def _printrun(self):
-        '''
-            Basically prints all commands, without running it
-        '''
-        with open('kittens.fl', 'a') as handle:
-            handle.write('DPPP {}\n'.format(self.ddecal))
-            handle.write('DPPP {}\n'.format(self.acal))
-            handle.write(self.fulimg+'\n')
-            self._init_losoto()
-            handle.write(self.losoto+'\n')
-
-    def _actualrun(self):
+    def execute(self):
         self.pickle_and_call('DPPP {}'.format(self.ddecal))
         self.pickle_and_call('DPPP {}'.format(self.acal))
         self.pickle_and_call(self.fulimg)
-        self._init_losoto()
-        self.pickle_and_call(self.losoto)
-
-
-    def execute(self):
-        if self.DEBUG:
-            self._printrun()
-        else:
-            self._actualrun()
-    
+        self.plot()
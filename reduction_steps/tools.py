@@ -1,7 +1,7 @@
 import numpy as np
-from losoto import h5parm
 import sys
 import os
+from .h5transform import H5Transform, CHUNK
 
 def parse_pset(fname):
     with open(fname, 'r') as handle:
@@ -22,14 +22,33 @@ def parse_pset(fname):
             newdata.append(''.join(list(filter(lambda y: y != ' ', x))))
     return newdata
 
-def process_diag(fname):
-    H5 = h5parm.h5parm(fname,readonly=False)
-    stb = H5.getSolset('sol000').getSoltab('amplitude000').getValues()
-    stb_shape = stb[0].shape
-    num_freqs = stb_shape[1]
-    for freq in range(num_freqs):
-        print(np.nanmean(stb[0][:,freq,:,:,:]))
-        mean_amp = np.nanmean(stb[0][:,freq,:,:,:])
-        stb[0][:,freq,:,:,:] *= 1/mean_amp
-    H5.getSolset('sol000').getSoltab('amplitude000').setValues(stb[0])
-    H5.close()
+def fuse_psets(ddecal, acal):
+    '''
+        A single DPPP parset that solves and applies: the ddecal parset with
+        ddecal.applysolution, writing where the applycal parset writes to.
+        Both are lists from parse_pset.
+    '''
+    fused = [x for x in ddecal if not x.startswith('msout.')]
+    if not any(x.startswith('msin.datacolumn=') for x in ddecal):
+        fused += [x for x in acal if x.startswith('msin.datacolumn=')]
+    fused += [x for x in acal if x.startswith('msout.')]
+    fused.append('ddecal.applysolution=true')
+    return fused
+
+def makedir(path):
+    '''
+        os.mkdir that accepts an existing directory, so that a step can be
+        run again after an interrupted run
+    '''
+    try:
+        os.mkdir(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+def process_diag(fname, chunk_bytes = CHUNK):
+    '''
+        Normalises the amplitudes of a diagonal solve to a mean of 1 per
+        frequency
+    '''
+    H5Transform(fname, chunk_bytes = chunk_bytes).normalise('amplitude000', 'freq').run()
@@ -0,0 +1,69 @@
+from __future__ import print_function
+import os
+import re
+import shutil
+import hashlib
+from cache import fingerprint_ms
+
+'''
+    Reuse of the reordered visibilities of wsclean between calls. wsclean
+    reorders the ms into temporary files before imaging or predicting; with
+    -save-reordered they are kept in -temp-dir, and a following call on the
+    same data passes -reuse-reordered instead of reordering again, e.g. the
+    predict after an image of a diagonal step.
+
+    The files are only reused when the ms are unchanged (by fingerprint),
+    and the data column and the options that shape the reordered data are
+    the same. Otherwise the folder is emptied and wsclean reorders anew.
+    The folder is DP5_SCRATCH (fast local disk) if set, else in the run.
+'''
+
+# Options that change what ends up in the reordered files
+# (uv cuts in lambda are applied when gridding, those in metres when reordering)
+SHAPE_OPTIONS = ['-data-column', '-channels-out', '-pol', '-intervals-out', '-interval',
+                 '-channel-range', '-field', '-spws', '-minuvw-m', '-maxuvw-m']
+
+class ReorderCache(object):
+    def __init__(self, fpath):
+        scratch = os.environ.get('DP5_SCRATCH')
+        if scratch:
+            # One folder per run, runs may share the scratch disk
+            run = hashlib.sha1(os.path.abspath(fpath).encode()).hexdigest()[:12]
+            self.root = os.path.join(scratch, 'reorder-{}'.format(run))
+        else:
+            self.root = os.path.join(fpath, 'reorder')
+        self.stamp = os.path.join(self.root, 'KEY')
+
+    def key(self, call, mslist):
+        digest = hashlib.sha1()
+        for option in SHAPE_OPTIONS:
+            match = re.search(r'(?<=\s){}\s+(\S+)'.format(re.escape(option)), call)
+            digest.update('{0}={1};'.format(option, match.group(1) if match else '').encode())
+        for ms in mslist:
+            digest.update(ms.rstrip('/').encode())
+            digest.update(fingerprint_ms(ms).encode())
+        return digest.hexdigest()
+
+    def run(self, call, mslist, runner):
+        '''
+            Runs the wsclean call through runner (a pickle_and_call), reusing
+            or saving the reordered data of mslist
+        '''
+        key = self.key(call, mslist)
+        try:
+            with open(self.stamp, 'r') as handle:
+                reuse = handle.read() == key
+        except IOError:
+            reuse = False
+        if not reuse:
+            self.clear()
+            os.makedirs(self.root)
+        flags = '-temp-dir {0} {1}'.format(self.root, '-reuse-reordered' if reuse else '-save-reordered')
+        ret = runner(call.replace('wsclean', 'wsclean {}'.format(flags), 1))
+        if not reuse and not ret:
+            with open(self.stamp, 'w') as handle:
+                handle.write(key)
+        return ret
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors = True)
@@ -0,0 +1,100 @@
+from __future__ import print_function
+import os
+import re
+import multiprocessing as mp
+
+'''
+    Keeps the work of a run within the machine. The ResourceManager decides
+    how many ms-level workers to start, and limit_threads rewrites the
+    thread count of every DPPP and wsclean call so that all workers together
+    never ask for more cores than there are.
+
+    The budget is passed on through the environment, so it also reaches
+    pool workers and nested runs (e.g. DP5.main started from map_runs.py):
+        DP5_CORES    total cores available to this process and its children
+        DP5_THREADS  threads a single DPPP/wsclean call may use
+'''
+
+GB = 1024.**3
+
+def total_cores():
+    if 'DP5_CORES' in os.environ:
+        return int(os.environ['DP5_CORES'])
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return mp.cpu_count()
+
+def total_memory():
+    '''
+        Physical memory in bytes
+    '''
+    try:
+        with open('/proc/meminfo', 'r') as handle:
+            for line in handle:
+                if line.startswith('MemTotal:'):
+                    return int(line.split()[1])*1024
+    except IOError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_PHYS_PAGES')
+
+class ResourceManager(object):
+    def __init__(self, cores = None, memory = None, min_threads = 1):
+        '''
+            cores and memory (in bytes) default to what the machine (or a
+            parent run through DP5_CORES) provides. min_threads is the least
+            number of threads a single task gets, which caps the number of
+            workers on machines with few cores per ms.
+        '''
+        self.cores = cores if cores else total_cores()
+        self.memory = memory if memory else total_memory()
+        self.min_threads = max(1, min_threads)
+
+    def workers(self, ntasks, task_memory = None):
+        '''
+            Number of workers to run ntasks tasks that each need task_memory bytes
+        '''
+        nworkers = min(max(1, ntasks), max(1, self.cores//self.min_threads))
+        if task_memory:
+            nworkers = min(nworkers, max(1, int(self.memory//task_memory)))
+        return nworkers
+
+    def threads(self, nworkers):
+        '''
+            Threads per task when nworkers tasks run at the same time
+        '''
+        return max(1, self.cores//max(1, nworkers))
+
+    def export(self, nworkers):
+        '''
+            Hands the per-worker budget to the environment, so every call
+            started from here (or from workers forked after this) obeys it
+        '''
+        threads = self.threads(nworkers)
+        os.environ['DP5_THREADS'] = str(threads)
+        os.environ['DP5_CORES'] = str(threads)
+        print('==== Using {0} worker(s) with {1} thread(s) each ({2} cores, {3:.1f} GB)'.format(nworkers, threads, self.cores, self.memory/GB))
+        return threads
+
+def limit_threads(call, threads = None):
+    '''
+        Caps the thread count of a DPPP (numthreads=) or wsclean (-j) call
+        at threads, DP5_THREADS by default, adding it if it is missing.
+        Other calls are returned unchanged.
+    '''
+    if threads is None:
+        threads = int(os.environ.get('DP5_THREADS', 0))
+    if not threads:
+        return call
+    tool = os.path.basename(call.split(' ', 1)[0])
+    if tool in ('DPPP', 'DP3'):
+        match = re.search(r'(?<=\s)numthreads=(\d+)', call)
+        if match:
+            return call[:match.start(1)] + str(min(threads, int(match.group(1)))) + call[match.end(1):]
+        return '{0} numthreads={1}'.format(call, threads)
+    elif tool == 'wsclean':
+        match = re.search(r'(?<=\s)-j\s+(\d+)', call)
+        if match:
+            return call[:match.start(1)] + str(min(threads, int(match.group(1)))) + call[match.end(1):]
+        return call.replace('wsclean', 'wsclean -j {}'.format(threads), 1)
+    return call
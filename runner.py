@@ -0,0 +1,95 @@
+from __future__ import print_function
+import os
+import time
+import subprocess
+from resources import limit_threads
+
+'''
+    The one place where the external tools (DPPP, wsclean, losoto,
+    makesourcedb, ...) are started. Every call is journalled together with
+    its wall time, CPU time, exit code and memory use, which is what
+    DP5-tools.py profile summarises.
+'''
+
+def _children(pid):
+    '''
+        Direct children of pid, from /proc
+    '''
+    try:
+        with open('/proc/{0}/task/{0}/children'.format(pid), 'r') as handle:
+            return [int(child) for child in handle.read().split()]
+    except (IOError, OSError, ValueError):
+        return []
+
+def _rss(pid):
+    '''
+        Resident memory in bytes of pid, 0 if it is gone
+    '''
+    try:
+        with open('/proc/{}/status'.format(pid), 'r') as handle:
+            for line in handle:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])*1024
+    except (IOError, OSError, ValueError):
+        pass
+    return 0
+
+def tree_rss(pid):
+    '''
+        Resident memory of pid and all its descendants together
+    '''
+    total = 0
+    todo = [pid]
+    while todo:
+        pid = todo.pop()
+        total += _rss(pid)
+        todo += _children(pid)
+    return total
+
+def run_command(call, log = None, step = None, ms = None, interval = 1.):
+    '''
+        Runs call through the shell like subprocess.call and returns its
+        exit code. The thread count is capped by limit_threads. With a log
+        (a journal_pickling.Locker) the call is journalled with:
+            wall, user, sys   seconds, CPU time includes everything the
+                              command started and waited for
+            maxrss            peak RSS of the largest single process (bytes)
+            peak_rss          peak RSS of the whole process tree, sampled
+                              from /proc every interval seconds (bytes)
+            exitcode          negative if killed by a signal, None if the
+                              call was interrupted
+        A 'start' record is journalled before the call is started, so a
+        call that takes the whole process down with it still leaves a trace.
+    '''
+    call = limit_threads(call)
+    tool = os.path.basename(call.split(None, 1)[0]) if call.strip() else None
+    if log is not None:
+        log.add_record('start', call = call, step = step, ms = ms, tool = tool)
+    start = time.time()
+    proc = subprocess.Popen(call, shell = True)
+    peak = 0
+    # Start polling fast, so short calls do not wait for a full interval
+    wait = 0.01
+    status = None
+    rusage = None
+    try:
+        while True:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid:
+                break
+            peak = max(peak, tree_rss(proc.pid))
+            time.sleep(wait)
+            wait = min(interval, 2*wait)
+        if os.WIFSIGNALED(status):
+            proc.returncode = -os.WTERMSIG(status)
+        else:
+            proc.returncode = os.WEXITSTATUS(status)
+    finally:
+        end = time.time()
+        if log is not None:
+            fields = {'wall': end - start, 'exitcode': proc.returncode, 'peak_rss': peak, 'tool': tool}
+            if rusage is not None:
+                fields.update({'user': rusage.ru_utime, 'sys': rusage.ru_stime,
+                               'maxrss': rusage.ru_maxrss*1024})
+            log.add_calls(call, step, ms, **fields)
+    return proc.returncode
@@ -0,0 +1,204 @@
+from __future__ import print_function
+import os
+import time
+import traceback
+import journal_pickling as jp
+
+'''
+    A small dependency graph scheduler. DP5.py compiles the reduction string
+    into a TaskGraph, and every task starts as soon as the tasks it depends
+    on are finished, instead of waiting for the slowest ms of a step.
+'''
+
+class Task(object):
+    def __init__(self, name, func, args = (), deps = (), ms = None, step = None, local = False, threads = None, outputs = (), markers = ()):
+        self.name = name
+        self.func = func
+        self.args = args
+        self.deps = list(deps)
+        self.ms = ms
+        self.step = step
+        self.local = local
+        self.threads = threads
+        self.outputs = list(outputs)
+        self.markers = list(markers)
+
+class Checkpoint(object):
+    '''
+        Remembers which tasks of a run finished, and the files they produced.
+        Every finished task is a 'done' record in the journal, a fresh
+        (not resumed) run starts with a 'reset' record. Tasks that cannot
+        run twice (they change a ms in place) also leave marker files as
+        soon as they finish, which count on a resume even if the run died
+        before the task made it into the journal.
+    '''
+    def __init__(self, fname, resume = False):
+        self.log = jp.Locker(fname)
+        self.resume = resume
+        self.done = {}
+        if resume:
+            for record in self.log.query(kind = None):
+                if record['type'] == 'reset':
+                    self.done = {}
+                elif record['type'] == 'done':
+                    self.done[record['task']] = record
+        else:
+            self.log.add_record('reset')
+
+    def finished(self, task):
+        '''
+            True if the task finished before and all its outputs still exist
+        '''
+        # A task that changed a ms in place is never run twice
+        if self.resume and task.markers and all(os.path.isfile(fname) for fname in task.markers):
+            return True
+        if task.name not in self.done:
+            return False
+        return all(os.path.exists(fname) for fname in self.done[task.name]['outputs'])
+
+    def add(self, task, start, end):
+        self.done[task.name] = self.log.add_record('done', task = task.name, step = task.step, ms = task.ms,
+                                                   start = start, end = end, outputs = task.outputs)
+
+def _run_task(name, func, args, threads = None, markers = ()):
+    '''
+        Runs a single task, normally inside a pool worker. Exceptions are
+        returned rather than raised, so the scheduler knows which task failed.
+        threads overrides the DP5_THREADS budget for the duration of the task.
+        The marker files are written right after the task succeeded.
+    '''
+    old_threads = os.environ.get('DP5_THREADS')
+    if threads:
+        os.environ['DP5_THREADS'] = str(threads)
+    start = time.time()
+    try:
+        func(*args)
+        for fname in markers:
+            with open(fname, 'w') as handle:
+                handle.write('{}\n'.format(name))
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    end = time.time()
+    if old_threads is None:
+        os.environ.pop('DP5_THREADS', None)
+    else:
+        os.environ['DP5_THREADS'] = old_threads
+    return name, start, end, error
+
+class TaskGraph(object):
+    def __init__(self):
+        self.tasks = []
+        self.names = {}
+        self.timings = []
+
+    def add(self, name, func, args = (), deps = (), ms = None, step = None, local = False, threads = None, outputs = (), markers = ()):
+        '''
+            Adds a task and returns its name. Dependencies have to be added
+            before the tasks that depend on them, so the order in which tasks
+            are added is always a valid serial order.
+        '''
+        if name in self.names:
+            raise ValueError('Task {} is already in the graph'.format(name))
+        for dep in deps:
+            if dep not in self.names:
+                raise ValueError('Task {0} depends on unknown task {1}'.format(name, dep))
+        task = Task(name, func, args, deps, ms, step, local, threads, outputs, markers)
+        self.names[name] = task
+        self.tasks.append(task)
+        return name
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __iter__(self):
+        return iter(self.tasks)
+
+    def _record(self, name, start, end, checkpoint = None):
+        task = self.names[name]
+        self.timings.append({'task': name, 'step': task.step, 'ms': task.ms,
+                             'start': start, 'end': end, 'wall': end - start})
+        if checkpoint is not None:
+            checkpoint.add(task, start, end)
+        print('==== {0} finished in {1:.1f} s'.format(name, end - start))
+
+    def resumed(self, checkpoint):
+        '''
+            Names of the tasks that do not have to run again: they finished
+            in an earlier run, their outputs still exist, and the same holds
+            for everything they depend on
+        '''
+        skip = set()
+        for task in self.tasks:
+            if checkpoint.finished(task) and all(dep in skip for dep in task.deps):
+                skip.add(task.name)
+        return skip
+
+    def run(self, pool, poll = 0.5, checkpoint = None):
+        '''
+            Executes the graph on a multiprocessing pool. Local tasks run
+            in this process, e.g. because they need to start processes of
+            their own. On a failure no new tasks are started, the running
+            ones are waited for and a RuntimeError is raised.
+            With a checkpoint, tasks that finished in an earlier run are
+            skipped, and every finished task is added to it.
+        '''
+        done = set()
+        if checkpoint is not None:
+            done = self.resumed(checkpoint)
+            for task in self.tasks:
+                if task.name in done:
+                    print('==== {} already finished, skipping'.format(task.name))
+                    continue
+                if checkpoint.resume:
+                    # Outputs of an interrupted attempt are not to be trusted
+                    for fname in task.outputs:
+                        if os.path.isfile(fname):
+                            os.remove(fname)
+                # Markers of an earlier run of a task that runs again
+                for fname in task.markers:
+                    if os.path.isfile(fname):
+                        os.remove(fname)
+        waiting = [task for task in self.tasks if task.name not in done]
+        running = {}
+        failed = []
+        while waiting or running:
+            if not failed:
+                ready = [task for task in waiting if all(dep in done for dep in task.deps)]
+                for task in ready:
+                    waiting.remove(task)
+                    if task.local:
+                        name, start, end, error = _run_task(task.name, task.func, task.args, task.threads, task.markers)
+                        if error is None:
+                            done.add(name)
+                            self._record(name, start, end, checkpoint)
+                        else:
+                            failed.append((name, error))
+                            break
+                    else:
+                        running[task.name] = pool.apply_async(_run_task, (task.name, task.func, task.args, task.threads, task.markers))
+                if ready and not failed:
+                    continue
+            if not running:
+                if failed:
+                    break
+                raise RuntimeError('Cannot schedule {} tasks, their dependencies never finish'.format(len(waiting)))
+            finished = [name for name in running if running[name].ready()]
+            if not finished:
+                time.sleep(poll)
+                continue
+            for name in finished:
+                try:
+                    name, start, end, error = running.pop(name).get()
+                except Exception:
+                    error = traceback.format_exc()
+                if error is None:
+                    done.add(name)
+                    self._record(name, start, end, checkpoint)
+                else:
+                    failed.append((name, error))
+        if failed:
+            for name, error in failed:
+                print('==== {} failed:'.format(name))
+                print(error)
+            raise RuntimeError('{0} task(s) failed, first one: {1}'.format(len(failed), failed[0][0]))
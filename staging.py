@@ -0,0 +1,175 @@
+from __future__ import print_function
+import os
+import sys
+import time
+import errno
+import fcntl
+import shutil
+import hashlib
+import threading
+from multiprocessing.pool import ThreadPool
+
+'''
+    Brings measurement sets and images into a run without a serial copy.
+    Files are cloned with a reflink (btrfs, XFS, ...) where the filesystem
+    can, which is instant and copy-on-write, and copied in parallel chunks
+    otherwise. Hard links are only made on request: DPPP and wsclean
+    change tables in place, which through a hard link would change the
+    original as well.
+'''
+
+FICLONE = 0x40049409
+CHUNK = 64*1024**2
+MODES = ('auto', 'reflink', 'copy', 'hardlink')
+
+class Progress(object):
+    '''
+        Thread safe byte counter that prints at most every interval seconds
+    '''
+    def __init__(self, total, label, interval = 5.):
+        self.total = total
+        self.label = label
+        self.interval = interval
+        self.done = 0
+        self.start = time.time()
+        self.last = 0.
+        self.lock = threading.Lock()
+
+    def add(self, nbytes):
+        with self.lock:
+            self.done += nbytes
+            now = time.time()
+            if now - self.last >= self.interval or self.done >= self.total:
+                self.last = now
+                rate = self.done/max(now - self.start, 1e-6)/1024.**2
+                print('==== {0}: {1:.1f}/{2:.1f} GB ({3:.0f}%, {4:.0f} MB/s)'.format(self.label, self.done/1024.**3,
+                      self.total/1024.**3, 100.*self.done/max(self.total, 1), rate))
+                sys.stdout.flush()
+
+def reflink(src, dst):
+    '''
+        Clones src to dst, returns False if the filesystem cannot
+    '''
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            except (IOError, OSError):
+                cloned = False
+            else:
+                cloned = True
+    if not cloned:
+        os.remove(dst)
+    return cloned
+
+def _copy_chunk(args):
+    src, dst, offset, size, progress = args
+    with open(src, 'rb') as fsrc:
+        with open(dst, 'r+b') as fdst:
+            fsrc.seek(offset)
+            fdst.seek(offset)
+            left = size
+            while left > 0:
+                data = fsrc.read(min(left, 4*1024**2))
+                if not data:
+                    break
+                fdst.write(data)
+                left -= len(data)
+    progress.add(size)
+
+def checksum(fname, blocksize = 4*1024**2):
+    digest = hashlib.sha1()
+    with open(fname, 'rb') as handle:
+        while True:
+            data = handle.read(blocksize)
+            if not data:
+                break
+            digest.update(data)
+    return digest.hexdigest()
+
+def stage_files(pairs, mode = 'auto', threads = None, verify = False, chunk = CHUNK, label = 'Staging'):
+    '''
+        Copies every (src, dst) file pair. mode is one of
+            auto      reflink where possible, else copy
+            reflink   reflink only, fails if the filesystem cannot
+            copy      parallel chunked copy
+            hardlink  hard link where possible (only for data nobody
+                      changes in place), else copy
+        Large files are split into chunks of chunk bytes, and the chunks of
+        all files are copied by threads threads. verify compares the sha1
+        of every copied file with its source afterwards.
+    '''
+    if mode not in MODES:
+        raise ValueError('Unknown staging mode {}'.format(mode))
+    pairs = list(pairs)
+    if threads is None:
+        threads = int(os.environ.get('DP5_CORES', 8))
+    chunks = []
+    copied = []
+    total = 0
+    for src, dst in pairs:
+        if os.path.lexists(dst):
+            os.remove(dst)
+        if mode == 'hardlink':
+            try:
+                os.link(src, dst)
+                continue
+            except OSError as err:
+                if err.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                    raise
+        if mode in ('auto', 'reflink') and reflink(src, dst):
+            continue
+        if mode == 'reflink':
+            raise OSError(errno.EOPNOTSUPP, 'Cannot reflink {0} to {1}'.format(src, dst))
+        size = os.path.getsize(src)
+        with open(dst, 'wb') as handle:
+            handle.truncate(size)
+        chunks += [(src, dst, offset, min(chunk, size - offset)) for offset in range(0, size, chunk)]
+        copied.append((src, dst))
+        total += size
+    pool = ThreadPool(max(1, threads))
+    try:
+        if chunks:
+            progress = Progress(total, label)
+            pool.map(_copy_chunk, [args + (progress,) for args in chunks], chunksize = 1)
+        for src, dst in copied:
+            shutil.copystat(src, dst)
+        if verify:
+            sums = pool.map(lambda pair: (checksum(pair[0]), checksum(pair[1])), pairs)
+            bad = [dst for (src, dst), (a, b) in zip(pairs, sums) if a != b]
+            if bad:
+                raise IOError('Checksum mismatch after staging: {}'.format(', '.join(bad)))
+            print('==== {0}: verified {1} file(s)'.format(label, len(pairs)))
+    finally:
+        pool.close()
+        pool.join()
+
+def stage_tree(src, dst, mode = 'auto', threads = None, verify = False, chunk = CHUNK):
+    '''
+        Stages the directory tree src (e.g. a folder of measurement sets)
+        to dst, which must not exist yet, like shutil.copytree
+    '''
+    pairs = []
+    for root, dirs, files in os.walk(src):
+        target = os.path.join(dst, os.path.relpath(root, src))
+        os.makedirs(target)
+        for name in dirs + files:
+            path = os.path.join(root, name)
+            if os.path.islink(path):
+                os.symlink(os.readlink(path), os.path.join(target, name))
+        dirs[:] = [name for name in dirs if not os.path.islink(os.path.join(root, name))]
+        pairs += [(os.path.join(root, name), os.path.join(target, name)) for name in files
+                  if not os.path.islink(os.path.join(root, name))]
+    stage_files(pairs, mode, threads, verify, chunk, 'Staging {}'.format(src))
+    for root, dirs, files in os.walk(src):
+        shutil.copystat(root, os.path.join(dst, os.path.relpath(root, src)))
+
+def updated(src, dst):
+    '''
+        True if dst is missing or older than src, for incremental copies.
+        copystat does not keep the nanoseconds of mtime on every platform,
+        so a copy is only older by more than a millisecond.
+    '''
+    if not os.path.isfile(dst):
+        return True
+    return os.path.getsize(src) != os.path.getsize(dst) or os.path.getmtime(src) > os.path.getmtime(dst) + 1e-3